@@ -9,24 +9,203 @@ Created on Nov 8, 2019
 
 Flask-based RESTful API for KBQA on DBpedia
 '''
-from flask import Flask, jsonify, request
-import tensorflow as tf
+import os
+import json
+import threading
+
+from flask import Flask, Response, jsonify, request, stream_with_context
 
 from request import KBQA
+from scheduler import MicroBatchScheduler, QueueFull
+from budget import Budget
+from cache import AnswerCache
+from metrics import registry, request_seconds
+from tracing import Tracer, Trace, JsonLines, null_span
+
+# question models backend: 'keras', or 'numpy' to start without TensorFlow from the exported weights (see export.py,
+# falls back to 'keras' when they were not exported), set with KBQA_ENGINE
+engine = os.environ.get('KBQA_ENGINE', 'keras')
+# threads of the TensorFlow session, None to use all cores (keep room for the MP threads)
+intra_op_threads = None
+inter_op_threads = None
+# micro-batching: concurrent questions are parsed and linked together (see scheduler.py)
+max_batch_size = 32
+max_wait_ms = 10
+max_queue_size = 1000
+mp_workers = 4
+# linked questions waiting for or running on the MP workers, the scheduler stops batching beyond that
+max_answering = 16
+# questions of a single /ask_batch request scheduled at a time
+max_in_flight = 64
+# answers cached in memory
+answer_cache_size = 10000
+# shelve file for a persistent answer cache (one serving process only, not with serve.py)
+answer_cache_path = None
+# latency budget of a question in seconds (None for no limit), a request can set its own with budget_ms
+budget_seconds = 30
+# answer as soon as the required components are loaded, while the optional ones (Magnitude for OOV words) are loading
+serve_degraded = True
+# per-request traces as JSON lines (see tracing.py): a fraction of the requests is sampled,
+# a request asks for a trace with the header X-Trace: 1 (X-Trace: payload to also record the spans and ids)
+trace_path = 'traces.jsonl'
+trace_sample_rate = 0.0
+trace_payloads = False
+# JSON lines log of the /ask requests with their latency and stage breakdown, replayed by loadtest.py (None to disable)
+request_log_path = None
 
 app = Flask(__name__)
-model = KBQA()
-global graph
-graph = tf.get_default_graph() 
+# the model owns its graph and session and is warmed up before serving
+# the components are loaded in background threads while the server starts, see /readyz
+model = KBQA(engine=engine, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads, wait=False)
+scheduler = None
+scheduler_lock = threading.Lock()
+# invalidated when the KG, the indices or the models change
+# degraded answers are not cached
+answer_cache = AnswerCache(model.fingerprint, answer_cache_size, answer_cache_path,
+                           cacheable=lambda response: not response['degradations'])
+tracer = Tracer(trace_path, trace_sample_rate, trace_payloads)
+request_log = JsonLines(request_log_path) if request_log_path else None
+
+
+def get_scheduler():
+    '''
+    The scheduler threads are started in the serving process (threads do not survive a fork, see serve.py)
+    '''
+    global scheduler
+    with scheduler_lock:
+        if scheduler is None or scheduler.pid != os.getpid():
+            scheduler = MicroBatchScheduler(model, max_batch_size, max_wait_ms, max_queue_size, mp_workers, max_answering)
+    return scheduler
+
+
+def submit(question, top_n=3, budget=None, trace=null_span):
+    '''
+    Answers from the cache, from a computation of the same question in progress or from the scheduler
+    trace -- the stages are recorded only if the answer is computed for this request
+    '''
+    return answer_cache.get((model.tokenize(question), top_n), lambda: get_scheduler().submit(question, top_n, budget=budget, trace=trace))
+
+
+def ready():
+    return model.ready(required_only=serve_degraded)
+
+
+def not_ready():
+    return jsonify({'error': 'loading', 'components': model.status()}), 503
+
+
+def request_trace(name, **attributes):
+    header = request.headers.get('X-Trace', '').lower()
+    asked = header not in ('', '0', 'false')
+    trace = tracer.start(name, force=asked, payloads=True if header == 'payload' else None, **attributes)
+    if trace is null_span and request_log is not None:
+        # stage breakdown for the request log only
+        trace = Trace(name, export=False, **attributes)
+    return trace
+
+
+def log_request(trace, question, top_n, budget, status, response=None):
+    if request_log is None:
+        return
+    request_log.write({'timestamp': trace.start, 'question': question, 'top_n': top_n, 'budget_ms': budget * 1000 if budget else None,
+                       'status': status, 'latency_ms': (trace.end - trace.start) * 1000,
+                       'degradations': response['degradations'] if response else [], 'stages': trace.stages()})
+
+
+def request_budget():
+    budget_ms = request.args.get('budget_ms', type=float)
+    return budget_ms / 1000. if budget_ms else budget_seconds
 
 
 @app.route('/ask', methods=['GET'])
 def ask_qamp():
     question = request.args.get('question', type=str)
-    with graph.as_default():
-        answers = model.request(question, verbose=False)
-    return jsonify({'answers': answers})
+    top_n = request.args.get('top_n', default=3, type=int)
+    if not ready():
+        return not_ready()
+    budget = request_budget()
+    trace = request_trace('ask', question=question)
+    response, status = None, 500
+    with request_seconds.time(endpoint='ask'):
+        try:
+            with trace:
+                response = submit(question, top_n, Budget(budget), trace).result()
+            status = 200
+        except QueueFull:
+            status = 503
+            return jsonify({'error': 'too many requests'}), 503
+        finally:
+            # written after the response is computed
+            tracer.finish(trace)
+            log_request(trace, question, top_n, budget, status, response)
+    # degradations applied to answer within the budget
+    response = jsonify(response)
+    if trace is not null_span and trace.export:
+        response.headers['X-Trace-Id'] = trace.trace_id
+    return response
+
+
+@app.route('/ask_batch', methods=['POST'])
+def ask_batch():
+    '''
+    JSON lines in: {"question": "..."} or a JSON string per line
+    JSON lines out: {"index": <input line>, "answers": [...], "degradations": [...]} or {"index": ..., "error": "..."}
+    in completion order
+    '''
+    if not ready():
+        return not_ready()
+    lines = [line for line in request.get_data(as_text=True).split('\n') if line.strip()]
+    top_n = request.args.get('top_n', default=3, type=int)
+    budget = request_budget()
+    questions, errors = {}, []
+    for i, line in enumerate(lines):
+        try:
+            question = json.loads(line)
+        except ValueError:
+            question = None
+        if isinstance(question, dict):
+            question = question.get('question')
+        if isinstance(question, str):
+            questions[i] = question
+        else:
+            errors.append({'index': i, 'error': 'expected {"question": "..."} or a string'})
+
+    def generate():
+        for record in errors:
+            yield json.dumps(record) + '\n'
+        indices = list(questions)
+        for i, response, error in get_scheduler().map_unordered((questions[i] for i in indices), top_n, max_in_flight, submit, budget):
+            record = {'index': indices[i], 'error': error} if error else dict(response, index=indices[i])
+            yield json.dumps(record) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # the process is alive, the components may still be loading
+    return jsonify({'status': 'alive'})
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # ready to answer, degraded while optional components are loading
+    status = {'ready': ready(), 'degraded': not model.ready(), 'components': model.status()}
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Prometheus text format
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({'scheduler': get_scheduler().stats(),
+                    'parse_cache': model.parse_cache.stats() if model.parse_cache is not None else None,
+                    'answer_cache': answer_cache.stats()})
 
 
 if __name__ == '__main__':
-    app.run()
+    app.run(threaded=True)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Latency budget of a request: the stages check the time left and degrade their work instead of running over
+'''
+import time
+
+
+class Budget:
+
+    def __init__(self, seconds=None):
+        '''
+        seconds -- time until the deadline, None for no deadline
+        '''
+        self.seconds = seconds
+        self.start = time.time()
+        # degradations applied to meet the deadline, reported in the response
+        self.degradations = []
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def remaining(self):
+        if self.seconds is None:
+            return float('inf')
+        return self.seconds - self.elapsed()
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def pressure(self):
+        '''
+        Fraction of the budget spent
+        '''
+        if self.seconds is None:
+            return 0.
+        return self.elapsed() / self.seconds
+
+    def degrade(self, degradation):
+        if degradation not in self.degradations:
+            self.degradations.append(degradation)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Bounded in-memory caches for the QA pipeline
+'''
+import os
+import time
+import shelve
+import pickle as pkl
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+import numpy as np
+
+from metrics import cache_requests
+
+
+class LRUCache:
+    '''
+    Least recently used cache with at most max_size entries, safe to share between threads
+    '''
+
+    def __init__(self, max_size=10000, path=None, version=None, name=None):
+        '''
+        path -- pickle file to restore the entries from and to save them to (optional)
+        version -- entries persisted with a different version are discarded, e.g. after the models were retrained
+        name -- label of the hits and misses in the metrics (not counted without a name)
+        '''
+        self.max_size = max_size
+        self.name = name
+        self.path = path
+        self.version = version
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                if self.name:
+                    cache_requests.inc(cache=self.name, outcome='hit')
+                return self.entries[key]
+            self.misses += 1
+            if self.name:
+                cache_requests.inc(cache=self.name, outcome='miss')
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            # evict the least recently used entries
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0}
+
+    def save(self, path=None):
+        path = path or self.path
+        with self.lock:
+            entries = list(self.entries.items())
+        with open(path, 'wb') as f:
+            pkl.dump({'version': self.version, 'entries': entries}, f)
+
+    def load(self, path=None):
+        path = path or self.path
+        with open(path, 'rb') as f:
+            saved = pkl.load(f)
+        if saved['version'] != self.version:
+            print("Discarded the cache in %s: version %s instead of %s" % (path, saved['version'], self.version))
+            return
+        for key, value in saved['entries'][-self.max_size:]:
+            self.put(key, value)
+
+
+class AnswerCache:
+    '''
+    Answers keyed by the canonical question and a version of everything they depend on (KG, indices, models):
+    bounded in-memory tier, optional persistent tier, concurrent identical questions are computed once
+    '''
+
+    def __init__(self, fingerprint, max_size=10000, path=None, check_interval=60, window=10000, cacheable=None, max_disk_size=100000):
+        '''
+        fingerprint -- function returning the current version, e.g. KBQA.fingerprint
+        path -- shelve file for the persistent tier (one serving process only)
+        check_interval -- seconds between the version checks (in a background thread), a new version invalidates the cached answers
+        window -- number of the most recent requests the latency distributions are computed on
+        cacheable -- function telling whether an answer is stored (all answers by default)
+        max_disk_size -- answers kept in the persistent tier, the oldest ones are dropped beyond that
+        '''
+        self.fingerprint = fingerprint
+        self.cacheable = cacheable
+        # computed on the first request (the indices may still be loading)
+        self.version = None
+        self.checked = 0
+        self.checking = False
+        self.check_interval = check_interval
+        # only one request computes the first version
+        self.version_lock = threading.Lock()
+        self.memory = LRUCache(max_size)
+        self.disk = shelve.open(path) if path else None
+        self.max_disk_size = max_disk_size
+        # keys of the persistent answers in insertion order, to evict without listing the shelve (read once here)
+        self.disk_keys = OrderedDict.fromkeys(key for key in self.disk.keys() if key != 'version') if self.disk is not None else OrderedDict()
+        # futures of the answers being computed
+        self.in_flight = {}
+        # reentrant: callbacks of futures that are already done run in the calling thread
+        self.lock = threading.RLock()
+        self.latencies = {outcome: deque(maxlen=window) for outcome in self.outcomes}
+        self.counts = {outcome: 0 for outcome in self.outcomes}
+
+    outcomes = ['memory', 'disk', 'coalesced', 'miss']
+
+    def check_version(self):
+        '''
+        The first version is computed by the first request, the later checks run in a background thread
+        (started on demand: threads do not survive the fork of serve.py)
+        '''
+        if self.version is None:
+            with self.version_lock:
+                # a failed check is retried after check_interval, nothing is cached meanwhile
+                if self.version is None and time.time() - self.checked >= self.check_interval:
+                    self.checked = time.time()
+                    self.update_version()
+            return
+        with self.lock:
+            if self.checking or time.time() - self.checked < self.check_interval:
+                return
+            self.checking = True
+            self.checked = time.time()
+        threading.Thread(target=self.update_version, name='answer-cache-version', daemon=True).start()
+
+    def update_version(self):
+        try:
+            version = self.fingerprint()
+        except Exception as e:
+            print("Version check failed: %r" % e)
+            return
+        finally:
+            self.checking = False
+        with self.lock:
+            if version == self.version:
+                return
+            if self.version is not None:
+                print("New version %s: invalidated %d cached answers" % (version, len(self.memory)))
+                self.memory.clear()
+            # the persistent entries of other versions are never matched again
+            if self.disk is not None and self.disk.get('version') != version:
+                self.disk.clear()
+                self.disk['version'] = version
+                self.disk_keys.clear()
+            self.version = version
+
+    def get(self, key, compute):
+        '''
+        key -- canonical question and request options
+        compute -- function starting the computation of the answer and returning a Future, called on a miss
+        Returns a Future with the answer
+        '''
+        start = time.time()
+        self.check_version()
+        with self.lock:
+            versioned_key = (self.version, key)
+            future = None
+            answer = self.memory.get(versioned_key)
+            if answer is not None:
+                outcome = 'memory'
+            elif self.disk is not None and repr(versioned_key) in self.disk:
+                outcome = 'disk'
+                answer = self.disk[repr(versioned_key)]
+                self.memory.put(versioned_key, answer)
+            elif versioned_key in self.in_flight:
+                outcome = 'coalesced'
+                future = self.in_flight[versioned_key]
+            else:
+                outcome = 'miss'
+                future = compute()
+                self.in_flight[versioned_key] = future
+                future.add_done_callback(lambda future: self.store(versioned_key, future))
+            if future is None:
+                future = Future()
+                future.set_result(answer)
+            self.counts[outcome] += 1
+            cache_requests.inc(cache='answer', outcome=outcome)
+        future.add_done_callback(lambda future: self.latencies[outcome].append(time.time() - start))
+        return future
+
+    def store(self, versioned_key, future):
+        with self.lock:
+            self.in_flight.pop(versioned_key, None)
+            # errors and answers computed before a version was known are not cached
+            version = versioned_key[0]
+            if version is not None and future.exception() is None and (self.cacheable is None or self.cacheable(future.result())):
+                self.memory.put(versioned_key, future.result())
+                if self.disk is not None:
+                    disk_key = repr(versioned_key)
+                    if disk_key not in self.disk_keys:
+                        # evict the oldest answers
+                        while len(self.disk_keys) >= self.max_disk_size:
+                            del self.disk[self.disk_keys.popitem(last=False)[0]]
+                        self.disk_keys[disk_key] = None
+                    self.disk[disk_key] = future.result()
+
+    def stats(self):
+        stats = {'version': self.version, 'size': len(self.memory), 'disk_size': len(self.disk_keys), 'in_flight': len(self.in_flight)}
+        for outcome in self.outcomes:
+            latencies = np.array(self.latencies[outcome] or [0.]) * 1000
+            stats[outcome] = {'count': self.counts[outcome], 'latency_ms': {
+                'mean': float(np.mean(latencies)), 'p50': float(np.percentile(latencies, 50)),
+                'p95': float(np.percentile(latencies, 95)), 'max': float(np.max(latencies))}}
+        return stats
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
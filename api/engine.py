@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+NumPy inference engine for the question type and the EP spans models (no TensorFlow session at serving time)
+
+Export the weights of the trained Keras models once (see export.py):
+python export.py
+'''
+import numpy as np
+
+
+def export_weights(qt_model, ep_model, path):
+    '''
+    Dump the weights of both models into a single npz file: <model>/<layer name>/<weight index>
+    '''
+    weights = {}
+    for prefix, model in [('qt', qt_model), ('ep', ep_model)]:
+        for layer in model.layers:
+            for i, value in enumerate(layer.get_weights()):
+                weights['%s/%s/%d' % (prefix, layer.name, i)] = value
+    np.savez(path, **weights)
+    print("Exported %d weight arrays to %s" % (len(weights), path))
+
+
+class QuantizedKernel:
+    '''
+    int8 kernel with one float32 scale per output channel (column)
+    '''
+
+    def __init__(self, values, scale):
+        self.values = values
+        self.scale = scale
+        self.shape = values.shape
+
+    def cast(self):
+        '''
+        The same kernel with the integer values as float32 (NumPy has no int8 matrix product), to reuse over many products
+        '''
+        if self.values.dtype == np.float32:
+            return self
+        return QuantizedKernel(self.values.astype(np.float32), self.scale)
+
+
+def cast(kernel):
+    if isinstance(kernel, QuantizedKernel):
+        return kernel.cast()
+    return kernel
+
+
+def dot(x, kernel, out=None):
+    '''
+    Matrix product with a float32 or a quantized kernel: the integer values are accumulated in float32 and the
+    output is rescaled per channel
+    '''
+    if not isinstance(kernel, QuantizedKernel):
+        return np.dot(x, kernel, out=out)
+    out = np.dot(x, cast(kernel).values, out=out)
+    out *= kernel.scale
+    return out
+
+
+def hard_sigmoid(x):
+    # default recurrent activation of the Keras LSTM
+    return np.clip(0.2 * x + 0.5, 0., 1.)
+
+
+def softmax(x):
+    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+def lstm(x, kernel, recurrent_kernel, bias, go_backwards=False, return_sequences=True):
+    '''
+    Keras LSTM forward pass for a batch x of shape (batch, time, features), gates ordered as i, f, c, o
+    '''
+    n, steps, _ = x.shape
+    units = recurrent_kernel.shape[0]
+    # int8 kernels are cast once per call, not per time step
+    kernel, recurrent_kernel = cast(kernel), cast(recurrent_kernel)
+    # input projections for all time steps at once
+    z_x = dot(x, kernel) + bias
+    h = np.zeros((n, units), dtype=np.float32)
+    c = np.zeros((n, units), dtype=np.float32)
+    z = np.empty((n, 4 * units), dtype=np.float32)
+    outputs = np.empty((n, steps, units), dtype=np.float32) if return_sequences else None
+    time_steps = range(steps - 1, -1, -1) if go_backwards else range(steps)
+    for t in time_steps:
+        dot(h, recurrent_kernel, out=z)
+        z += z_x[:, t]
+        i = hard_sigmoid(z[:, :units])
+        f = hard_sigmoid(z[:, units:2*units])
+        c = f * c + i * np.tanh(z[:, 2*units:3*units])
+        o = hard_sigmoid(z[:, 3*units:])
+        h = o * np.tanh(c)
+        if return_sequences:
+            outputs[:, t] = h
+    return outputs if return_sequences else h
+
+
+def bidirectional(x, weights, return_sequences=True):
+    '''
+    Bidirectional layer with concatenated outputs: weights are the forward then the backward LSTM weights
+    '''
+    forward = lstm(x, *weights[:3], return_sequences=return_sequences)
+    backward = lstm(x, *weights[3:], go_backwards=True, return_sequences=return_sequences)
+    return np.concatenate([forward, backward], axis=-1)
+
+
+def crf_viterbi(energy, chain_kernel):
+    '''
+    Viterbi decoding as implemented by the keras_contrib CRF layer without a mask: energies are minimized and
+    the argmin table of the last step includes the transition to a virtual next tag 0 (the layer starts the
+    backtracking from there), so that the decoded paths are identical to the ones of the Keras model
+    '''
+    n, steps, n_tags = energy.shape
+    argmin_tables = np.empty((n, steps, n_tags), dtype=np.int64)
+    min_energy = np.zeros((n, n_tags), dtype=np.float32)
+    for t in range(steps):
+        # (batch, previous tag, next tag)
+        step_energy = chain_kernel[None, :, :] + (energy[:, t] + min_energy)[:, :, None]
+        argmin_tables[:, t] = np.argmin(step_energy, axis=1)
+        min_energy = np.min(step_energy, axis=1)
+    # backtracking
+    rows = np.arange(n)
+    paths = np.empty((n, steps), dtype=np.int64)
+    best = argmin_tables[rows, steps-1, 0]
+    for t in range(steps - 1, -1, -1):
+        best = argmin_tables[rows, t, best]
+        paths[:, t] = best
+    return paths
+
+
+class NumpyEngine:
+    '''
+    Forward pass of both models with plain NumPy: the weights are read-only, so one engine can be shared by threads
+    '''
+
+    def __init__(self, path):
+        '''
+        path -- weights exported with export_weights or quantized with quantize.py
+        '''
+        self.weights = {}
+        with np.load(path) as weights:
+            for name in weights.files:
+                if name.endswith('/scale'):
+                    continue
+                if name+'/scale' in weights.files:
+                    self.weights[name] = QuantizedKernel(weights[name], weights[name+'/scale'])
+                else:
+                    self.weights[name] = np.asarray(weights[name], dtype=np.float32)
+
+    def layer(self, model, name):
+        weights = []
+        while '%s/%s/%d' % (model, name, len(weights)) in self.weights:
+            weights.append(self.weights['%s/%s/%d' % (model, name, len(weights))])
+        return weights
+
+    def predict_question_types(self, x):
+        h = bidirectional(x, self.layer('qt', 'bilstm1'))
+        h = bidirectional(h, self.layer('qt', 'bilstm2'), return_sequences=False)
+        kernel, bias = self.layer('qt', 'output')
+        return softmax(dot(h, kernel) + bias)
+
+    def predict_tags(self, x):
+        h = bidirectional(x, self.layer('ep', 'bilstm1'))
+        h = bidirectional(h, self.layer('ep', 'bilstm2'))
+        kernel, bias = self.layer('ep', 'td')
+        h = dot(h, kernel) + bias
+        # CRF: kernel, chain kernel, bias, left and right boundary
+        kernel, chain_kernel, bias, left_boundary, right_boundary = self.layer('ep', 'crf')
+        energy = dot(h, kernel) + bias
+        energy[:, 0] += left_boundary
+        energy[:, -1] += right_boundary
+        return crf_viterbi(energy, chain_kernel)
+
+    def nbytes(self):
+        return sum(w.values.nbytes + w.scale.nbytes if isinstance(w, QuantizedKernel) else w.nbytes
+                   for w in self.weights.values())
+
+    def one_hot(self, tags):
+        n_tags = self.weights['ep/crf/1'].shape[0]
+        return np.eye(n_tags, dtype=np.float32)[tags]
+
+    def predict(self, x):
+        '''
+        Same outputs as the Keras models: question type probabilities and one-hot encoded tags
+        '''
+        x = np.asarray(x, dtype=np.float32)
+        return self.predict_question_types(x), self.one_hot(self.predict_tags(x))
+
+
+def validate(engine, qt_model, ep_model, x):
+    '''
+    Compare the NumPy engine against the Keras models on a batch of embedded questions
+    '''
+    qt, ep = engine.predict(x)
+    k_qt, k_ep = qt_model.predict(x), ep_model.predict(x)
+    print("Question type probabilities max abs difference: %.2e" % np.max(np.abs(qt - k_qt)))
+    print("Question type agreement: %.4f" % np.mean(np.argmax(qt, -1) == np.argmax(k_qt, -1)))
+    print("Tag agreement: %.4f" % np.mean(np.argmax(ep, -1) == np.argmax(k_ep, -1)))
+
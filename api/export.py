@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Export the trained question models into frozen, inference-only artifacts:
+* kbqa_inference.h5 -- both Keras models in a single file without the optimizer state (loaded without compile)
+* kbqa_weights.npz -- the weights for the NumPy engine (no TensorFlow at serving time, see engine.py)
+
+python export.py
+'''
+import time
+
+from engine import export_weights, validate, NumpyEngine
+from models import save_inference_model, load_inference_model
+from request import KBQA, model_path, engine_weights, frozen_model
+
+
+if __name__ == '__main__':
+    # rebuild the models from the training checkpoints
+    service = KBQA(engine='keras', fused=True, warm_up=False, frozen=False)
+    with service.keras_session():
+        save_inference_model(service.fused_model, model_path+frozen_model)
+        print("Saved the frozen model to %s" % (model_path+frozen_model))
+        export_weights(service.qt_model, service.ep_model, model_path+engine_weights)
+
+        # check on a sample of questions
+        x, _ = service.embed(["What are some other works of the author of The Phantom of the Opera?",
+                              "How many movies did Stanley Kubrick direct?",
+                              "Is Barack Obama a president of the United States?"])
+        validate(NumpyEngine(model_path+engine_weights), service.qt_model, service.ep_model, x)
+
+    # load times of the frozen artifacts
+    for name, load in [('frozen Keras model', lambda: load_inference_model(model_path+frozen_model)),
+                       ('NumPy engine', lambda: NumpyEngine(model_path+engine_weights))]:
+        start = time.time()
+        load()
+        print("%s loaded in %.2fs" % (name, time.time() - start))
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Replay a request log (request_log_path in app.py) against a running API or an in-process KBQA and report the
+throughput, the latency percentiles and the error rate
+
+Closed loop, 8 clients sending their next question as soon as they have an answer:
+python loadtest.py request_log.jsonl --url http://localhost:5000 --concurrency 8
+Open loop, the recorded arrival times twice as fast, or a Poisson arrival rate of 20 questions/s:
+python loadtest.py request_log.jsonl --url http://localhost:5000 --speed 2
+python loadtest.py request_log.jsonl --in-process --rate 20
+Save the report and fail when the latency or the error rate regressed against a previous report:
+python loadtest.py request_log.jsonl --rate 20 --report report.json --baseline baseline.json
+'''
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from scheduler import MicroBatchScheduler
+from budget import Budget
+
+percentiles = [50, 95, 99]
+
+
+def read_log(path, limit=None):
+    '''
+    Records of the logged requests in their arrival order, lines without a question are skipped
+    The log is written in completion order, the timestamp of a record is the start of its request
+    limit -- the first requests to arrive only
+    '''
+    records = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if isinstance(record, dict) and record.get('question'):
+                records.append(record)
+    records.sort(key=lambda record: record.get('timestamp', 0))
+    return records[:limit] if limit else records
+
+
+def arrivals(records, rate=None, speed=1., seed=0):
+    '''
+    Seconds from the start of the replay at which every request is sent
+    rate -- requests per second of a Poisson process (seeded: the same arrivals on every replay), None for the recorded times
+    speed -- replay the recorded times this many times faster
+    '''
+    if rate:
+        gaps = np.random.RandomState(seed).exponential(1. / rate, len(records))
+        # the first request at the start
+        return list(np.cumsum(gaps) - gaps[0])
+    # from the earliest arrival
+    timestamps = [record['timestamp'] for record in records if 'timestamp' in record]
+    start = min(timestamps) if timestamps else 0
+    return [(record.get('timestamp', start) - start) / speed for record in records]
+
+
+class HttpClient:
+
+    def __init__(self, url, top_n=None, budget_ms=None, timeout=60):
+        '''
+        top_n, budget_ms -- the same for every request instead of the recorded ones
+        '''
+        self.url = url.rstrip('/') + '/ask'
+        self.top_n = top_n
+        self.budget_ms = budget_ms
+        self.timeout = timeout
+
+    def __call__(self, record):
+        params = {'question': record['question'], 'top_n': self.top_n or record.get('top_n', 3)}
+        budget_ms = self.budget_ms or record.get('budget_ms')
+        if budget_ms:
+            params['budget_ms'] = budget_ms
+        try:
+            with urllib.request.urlopen(self.url + '?' + urllib.parse.urlencode(params), timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            raise RuntimeError("HTTP %d" % e.code)
+
+
+class LocalClient:
+    '''
+    In-process KBQA behind the micro-batching scheduler, as in the API
+    '''
+
+    def __init__(self, service, top_n=None, budget_ms=None, concurrency=8):
+        self.scheduler = MicroBatchScheduler(service, max_queue_size=max(1000, concurrency))
+        self.top_n = top_n
+        self.budget_ms = budget_ms
+
+    def __call__(self, record):
+        budget_ms = self.budget_ms or record.get('budget_ms')
+        return self.scheduler.ask(record['question'], self.top_n or record.get('top_n', 3), budget=Budget(budget_ms / 1000. if budget_ms else None))
+
+
+def send(client, record, scheduled):
+    '''
+    Latency from the scheduled send time: a request waiting for a free client counts (no coordinated omission)
+    '''
+    try:
+        response = client(record)
+        error = response.get('error') if isinstance(response, dict) else None
+        degraded = bool(isinstance(response, dict) and response.get('degradations'))
+    except Exception as e:
+        error, degraded = str(e) or type(e).__name__, False
+    return time.time() - scheduled, error, degraded
+
+
+def closed_loop(client, records, concurrency):
+    results = [None] * len(records)
+    requests = iter(enumerate(records))
+    lock = threading.Lock()
+
+    def run():
+        while True:
+            with lock:
+                i, record = next(requests, (None, None))
+            if record is None:
+                return
+            results[i] = send(client, record, time.time())
+
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def open_loop(client, records, offsets, concurrency):
+    '''
+    Send every request at its arrival time whether the previous requests were answered or not
+    concurrency -- requests in flight at most, later arrivals wait for a free client
+    '''
+    pool = ThreadPoolExecutor(concurrency)
+    start = time.time()
+    futures = []
+    for record, offset in zip(records, offsets):
+        delay = start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        futures.append(pool.submit(send, client, record, start + offset))
+    results = [future.result() for future in futures]
+    pool.shutdown()
+    return results
+
+
+def summary(latencies):
+    if not len(latencies):
+        return None
+    latencies = np.array(latencies) * 1000
+    stats = {'p%d' % p: float(np.percentile(latencies, p)) for p in percentiles}
+    stats.update({'mean': float(np.mean(latencies)), 'max': float(np.max(latencies))})
+    return stats
+
+
+def report(records, results, duration):
+    errors = Counter(error for _, error, _ in results if error)
+    n_errors = sum(errors.values())
+    return {'requests': len(results), 'duration_s': duration,
+            'throughput': (len(results) - n_errors) / duration if duration else 0.,
+            'errors': n_errors, 'error_rate': n_errors / float(len(results)) if results else 0.,
+            'error_types': dict(errors.most_common()),
+            'degraded': sum(degraded for _, _, degraded in results),
+            # answered requests only
+            'latency_ms': summary([latency for latency, error, _ in results if not error]),
+            # the latency recorded in the log, for comparison
+            'recorded_latency_ms': summary([record['latency_ms'] / 1000. for record in records if 'latency_ms' in record])}
+
+
+def regressions(current, baseline, tolerance=0.1):
+    '''
+    Latency percentiles more than tolerance slower and error rates more than tolerance higher than the baseline
+    '''
+    found = []
+    for p in percentiles:
+        key = 'p%d' % p
+        if current['latency_ms'] and baseline.get('latency_ms') and current['latency_ms'][key] > baseline['latency_ms'][key] * (1 + tolerance):
+            found.append("%s latency %.1f ms > %.1f ms" % (key, current['latency_ms'][key], baseline['latency_ms'][key]))
+    if current['error_rate'] > baseline['error_rate'] + tolerance * max(baseline['error_rate'], 0.01):
+        found.append("error rate %.3f > %.3f" % (current['error_rate'], baseline['error_rate']))
+    return found
+
+
+def print_report(report):
+    print("%d requests in %.1fs: %.2f answers/s" % (report['requests'], report['duration_s'], report['throughput']))
+    print("errors: %d (%.1f%%) %s" % (report['errors'], report['error_rate'] * 100, report['error_types'] or ''))
+    print("degraded: %d" % report['degraded'])
+    for name in ('latency_ms', 'recorded_latency_ms'):
+        if report[name]:
+            print("%s: %s" % (name, ', '.join('%s %.1f' % (key, value) for key, value in report[name].items())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay a request log against the KBQA API")
+    parser.add_argument('log', help="JSON lines request log")
+    parser.add_argument('--url', default='http://localhost:5000', help="running API")
+    parser.add_argument('--in-process', action='store_true', help="replay against an in-process KBQA instead of the API")
+    parser.add_argument('--concurrency', type=int, default=8, help="closed loop: clients, open loop: requests in flight at most")
+    parser.add_argument('--rate', type=float, help="open loop: Poisson arrivals per second")
+    parser.add_argument('--speed', type=float, help="open loop: replay the recorded arrival times this many times faster")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the Poisson arrivals")
+    parser.add_argument('--limit', type=int, help="replay the first requests of the log only")
+    parser.add_argument('--top-n', type=int, help="answers per question instead of the recorded number")
+    parser.add_argument('--budget-ms', type=float, help="latency budget of every request instead of the recorded one")
+    parser.add_argument('--report', help="save the report as JSON")
+    parser.add_argument('--baseline', help="report to compare with: exit with 1 when the latency or the error rate regressed")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    records = read_log(args.log, args.limit)
+    if not records:
+        sys.exit("no requests in %s" % args.log)
+    if args.in_process:
+        from request import KBQA
+        client = LocalClient(KBQA(engine='numpy'), args.top_n, args.budget_ms, args.concurrency)
+    else:
+        client = HttpClient(args.url, args.top_n, args.budget_ms)
+
+    start = time.time()
+    if args.rate or args.speed:
+        results = open_loop(client, records, arrivals(records, args.rate, args.speed or 1., args.seed), args.concurrency)
+    else:
+        results = closed_loop(client, records, args.concurrency)
+    result = report(records, results, time.time() - start)
+    print_report(result)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(result, json.load(f), args.tolerance)
+        for regression in found:
+            print("Regression: %s" % regression)
+        sys.exit(1 if found else 0)
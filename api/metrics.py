@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Counters and histograms of the QA pipeline exported in the Prometheus text format (GET /metrics)
+The metrics are kept per process: every worker of serve.py reports its own requests
+'''
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in labels)
+
+
+def format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+
+class Counter:
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, format_labels(key), format_value(value)))
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets) + [float('inf')]
+        # labels -> (counts per bucket, sum)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (self.name, format_labels(key, [('le', format_value(bound))]), cumulative))
+                lines.append('%s_sum%s %s' % (self.name, format_labels(key), format_value(total)))
+                lines.append('%s_count%s %d' % (self.name, format_labels(key), cumulative))
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help):
+        self.metrics.append(Counter(name, help))
+        return self.metrics[-1]
+
+    def histogram(self, name, help, buckets):
+        self.metrics.append(Histogram(name, help, buckets))
+        return self.metrics[-1]
+
+    def render(self):
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+
+latency_buckets = [.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60]
+size_buckets = [1, 10, 100, 1000, 10000, 100000, 1000000, 10000000]
+
+registry = Registry()
+# stages: embed, qtype, span_tagging, relation_detection, entity_linking, hop1, hop2, answer_resolution
+stage_seconds = registry.histogram('kbqa_stage_seconds', 'Duration of the QA pipeline stages', latency_buckets)
+request_seconds = registry.histogram('kbqa_request_seconds', 'Duration of the API requests', latency_buckets)
+es_requests = registry.counter('kbqa_es_requests_total', 'Elasticsearch requests')
+triples = registry.counter('kbqa_triples_total', 'Triples fetched from the KG')
+pages = registry.counter('kbqa_hop_pages_total', 'Subgraph partitions fetched from the KG')
+subgraph_entities = registry.histogram('kbqa_subgraph_entities', 'Entities per subgraph partition', size_buckets)
+subgraph_edges = registry.histogram('kbqa_subgraph_edges', 'Edges per subgraph partition', size_buckets)
+cache_requests = registry.counter('kbqa_cache_requests_total', 'Cache look ups by outcome')
+
+
+def stage(name):
+    return stage_seconds.time(stage=name)
+
+
+def timed(name):
+    '''
+    Decorator recording the duration of every call as the stage name
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
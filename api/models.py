@@ -13,20 +13,28 @@ Functions to load pre-trained models for KBQA
 from keras.models import Model, Input
 from keras.layers import LSTM, Embedding, Dense, Bidirectional, TimeDistributed
 from keras.optimizers import *
+from keras.models import load_model
+
+# the text helpers do not need Keras (see text.py)
+from text import collect_mentions, collect_all_mentions, preprocess_span
 
 
 # define bi-LSTM model architecture (loose embeddings layer to do on-the-fly embedding at inference time)
-def build_qt_inference_model(model_settings):
+# variable_length models accept inputs of any length, e.g. to run a batch padded only to its length bucket
+# compile=False skips the optimizer and loss setup which is not needed to predict
+def build_qt_inference_model(model_settings, variable_length=False, compile=True):
     # architecture
-    _input = Input(shape=(model_settings['max_len'], model_settings['emb_dim']), name='input')
+    max_len = None if variable_length else model_settings['max_len']
+    _input = Input(shape=(max_len, model_settings['emb_dim']), name='input')
     model = Bidirectional(LSTM(units=100, return_sequences=True, dropout=0.5,
                                recurrent_dropout=0.5), name='bilstm1')(_input)  # biLSTM
     model = Bidirectional(LSTM(units=100, return_sequences=False, dropout=0.5,
                                recurrent_dropout=0.5), name='bilstm2')(model)  # 2nd biLSTM
     _output = Dense(model_settings['n_tags'], activation='softmax', name='output')(model)  # a dense layer
-    model = Model(_input, _output)
-    model.compile(optimizer=Nadam(clipnorm=1), loss='categorical_crossentropy', metrics=['accuracy']) 
-    model.summary()
+    model = Model(_input, _output, name='qt')
+    if compile:
+        model.compile(optimizer=Nadam(clipnorm=1), loss='categorical_crossentropy', metrics=['accuracy']) 
+        model.summary()
     return model
 
 # load pre-trained EP spans parsing network
@@ -36,50 +44,61 @@ from keras_contrib.layers import CRF
 from keras_contrib import losses, metrics
 
 
-# prediction time span generator
-def collect_mentions(words, y_p, tag_ind):
-    e_span, e_spans = [], []
-    for w, pred in zip(words, y_p):
-        if pred == tag_ind:
-            e_span.append(w)
-        elif e_span:
-            e_spans.append(" ".join(e_span))
-            e_span = []
-    # add last span
-    if e_span:
-        e_spans.append(" ".join(e_span))
-        e_span = []
-    # remove duplicates
-    return list(set(e_spans))
-
-
 # define bi-LSTM model architecture (loose embeddings layer to do on-the-fly embedding at inference time)
-def build_ep_inference_model(model_settings):
+def build_ep_inference_model(model_settings, variable_length=False, compile=True):
     # architecture
-    input = Input(shape=(model_settings['max_len'], model_settings['emb_dim']), name='input')
+    max_len = None if variable_length else model_settings['max_len']
+    input = Input(shape=(max_len, model_settings['emb_dim']), name='input')
     model = Bidirectional(LSTM(units=100, return_sequences=True), name='bilstm1')(input)  # biLSTM
     model = Bidirectional(LSTM(units=100, return_sequences=True), name='bilstm2')(model)  # 2nd biLSTM
     model = TimeDistributed(Dense(model_settings['n_tags'], activation=None), name='td')(model)  # a dense layer
     crf = CRF(model_settings['n_tags'], name='crf')  # CRF layer
     out = crf(model)  # output
-    model = Model(input, out)
-    model.compile(optimizer=Nadam(lr=0.01, clipnorm=1), loss=losses.crf_loss, metrics=[metrics.crf_accuracy]) 
-    model.summary()
+    model = Model(input, out, name='ep')
+    if compile:
+        model.compile(optimizer=Nadam(lr=0.01, clipnorm=1), loss=losses.crf_loss, metrics=[metrics.crf_accuracy]) 
+        model.summary()
+    return model
+
+
+# run both pre-trained models in a single graph: one predict call per batch instead of two
+def build_fused_inference_model(qt_model, ep_model):
+    assert qt_model.input_shape == ep_model.input_shape
+    _input = Input(shape=qt_model.input_shape[1:], name='input')
+    model = Model(_input, [qt_model(_input), ep_model(_input)])
+    return model
+
+
+# alternative architecture for retraining: the question type and the EP spans share the first biLSTM
+def build_shared_encoder_model(qt_model_settings, ep_model_settings, variable_length=False, compile=True):
+    assert qt_model_settings['max_len'] == ep_model_settings['max_len']
+    assert qt_model_settings['emb_dim'] == ep_model_settings['emb_dim']
+    # architecture
+    max_len = None if variable_length else ep_model_settings['max_len']
+    _input = Input(shape=(max_len, ep_model_settings['emb_dim']), name='input')
+    encoder = Bidirectional(LSTM(units=100, return_sequences=True), name='bilstm1')(_input)  # shared biLSTM
+    # question type head
+    qt = Bidirectional(LSTM(units=100, return_sequences=False, dropout=0.5,
+                            recurrent_dropout=0.5), name='qt_bilstm2')(encoder)  # 2nd biLSTM
+    qt = Dense(qt_model_settings['n_tags'], activation='softmax', name='qt_output')(qt)  # a dense layer
+    # EP spans head
+    ep = Bidirectional(LSTM(units=100, return_sequences=True), name='ep_bilstm2')(encoder)  # 2nd biLSTM
+    ep = TimeDistributed(Dense(ep_model_settings['n_tags'], activation=None), name='td')(ep)  # a dense layer
+    crf = CRF(ep_model_settings['n_tags'], name='crf')  # CRF layer
+    ep = crf(ep)  # output
+    model = Model(_input, [qt, ep])
+    if compile:
+        model.compile(optimizer=Nadam(lr=0.01, clipnorm=1), loss=['categorical_crossentropy', losses.crf_loss],
+                      metrics={'qt_output': 'accuracy', 'crf': metrics.crf_accuracy})
+        model.summary()
     return model
 
 
-import re, string
+# frozen inference model: architecture and weights in a single file without the optimizer state
+def save_inference_model(model, path):
+    model.save(path, include_optimizer=False)
 
-def preprocess_span(span):
-    entity_label = " ".join(re.sub('([a-z])([A-Z])', r'\1 \2', span).split())
-    words = entity_label.split('_')
-    unique_words = []
-    for word in words:
-        # strip punctuation
-        word = "".join([c for c in word if c not in string.punctuation])
-        if word:
-            word = word.lower()
-            if word not in unique_words:
-                unique_words.append(word)
-    return " ".join(unique_words)
 
+# load a frozen model as is: no architecture rebuild, no compile
+def load_inference_model(path):
+    return load_model(path, custom_objects={'CRF': CRF}, compile=False)
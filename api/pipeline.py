@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+asyncio request pipeline for KBQA: entity linking (Elasticsearch) and relation detection for both hops run
+concurrently, the blocking stages run in executors so that a slow Elasticsearch call does not hold up other requests
+
+Compare with the sequential requests:
+python pipeline.py
+'''
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncKBQA:
+
+    def __init__(self, service, io_workers=8, mp_workers=4):
+        '''
+        service -- KBQA instance
+        io_workers -- threads waiting for Elasticsearch (the elasticsearch 7.0 client has no async transport)
+        mp_workers -- threads running the neural front-end and MP
+        '''
+        self.service = service
+        self.io_pool = ThreadPoolExecutor(io_workers)
+        self.mp_pool = ThreadPoolExecutor(mp_workers)
+        self.loop = None
+
+    async def run(self, pool, function, *args):
+        return await asyncio.get_event_loop().run_in_executor(pool, function, *args)
+
+    async def link(self, parse):
+        '''
+        Same output as KBQA.link for a single question
+        '''
+        e_cutoff, p_cutoff = self.service.cutoffs()
+        return await asyncio.gather(self.run(self.io_pool, self.service.entity_linking, parse['e_spans1'], False, e_cutoff, 0.7),
+                                    self.run(self.mp_pool, self.service.relation_detection, parse['p_spans1'], False, p_cutoff, 0),
+                                    self.run(self.mp_pool, self.service.relation_detection, parse['p_spans2'], False, p_cutoff, 0))
+
+    async def request(self, question, top_n=3, verbose=False):
+        parse = (await self.run(self.mp_pool, self.service.parse, [question]))[0]
+        links = await self.link(parse)
+        return await self.run(self.mp_pool, self.service.answer, parse, top_n, verbose, tuple(links))
+
+    async def request_batch(self, questions, top_n=3, verbose=False):
+        return await asyncio.gather(*[self.request(question, top_n, verbose) for question in questions])
+
+    def ask(self, question, top_n=3, verbose=False, timeout=None):
+        '''
+        Blocking call for threaded servers: the request runs on an event loop in a background thread
+        '''
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            threading.Thread(target=self.loop.run_forever, name='pipeline', daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(self.request(question, top_n, verbose), self.loop).result(timeout)
+
+
+if __name__ == '__main__':
+    from request import KBQA
+    questions = ["What are some other works of the author of The Phantom of the Opera?",
+                 "How many movies did Stanley Kubrick direct?",
+                 "Is Barack Obama a president of the United States?",
+                 "Which comic characters are painted by Bill Finger?"]
+    service = KBQA(engine='numpy', parse_cache_size=0)
+    pipeline = AsyncKBQA(service)
+
+    start = time.time()
+    sequential = [service.request(question) for question in questions]
+    print("Sequential: %.2fs" % (time.time() - start))
+
+    start = time.time()
+    concurrent = asyncio.get_event_loop().run_until_complete(pipeline.request_batch(questions))
+    print("asyncio pipeline: %.2fs" % (time.time() - start))
+    assert concurrent == sequential
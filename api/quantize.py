@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Post-training int8 quantization of the question models exported for the NumPy engine (see engine.py)
+
+The int8 weights take a quarter of the memory and disk space of the float32 weights but are not faster: NumPy has
+no int8 matrix product, so the kernels are cast to float32 for every layer call
+
+Quantize the exported weights and compare the int8 with the float32 engine on the LC-QuAD test split:
+python quantize.py
+'''
+import os
+import time
+
+import numpy as np
+
+from engine import NumpyEngine
+
+
+def quantize_kernel(kernel):
+    '''
+    Symmetric per-channel quantization: one scale per output column
+    '''
+    scale = np.max(np.abs(kernel), axis=0) / 127.
+    scale[scale == 0] = 1.
+    values = np.clip(np.round(kernel / scale), -127, 127).astype(np.int8)
+    return values, scale.astype(np.float32)
+
+
+def quantize_weights(path, quantized_path, skip=('ep/crf/1',)):
+    '''
+    Quantize all LSTM, Dense and CRF kernels, biases and the CRF transitions (skip) are kept in float32
+    '''
+    weights = {}
+    with np.load(path) as exported:
+        for name in exported.files:
+            value = exported[name]
+            if value.ndim == 2 and name not in skip:
+                weights[name], weights[name+'/scale'] = quantize_kernel(value)
+            else:
+                weights[name] = value
+    np.savez(quantized_path, **weights)
+    print("Quantized %d kernels" % len([name for name in weights if name.endswith('/scale')]))
+
+
+def report(service, engine, quantized_engine, questions, engine_path, quantized_path):
+    '''
+    Agreement of the int8 engine with the float32 engine, latency and size of both
+    '''
+    x, q_words = service.embed(questions)
+    lengths = [len(words) for words in q_words]
+
+    qt, ep = engine.predict(x)
+    q_qt, q_ep = quantized_engine.predict(x)
+    qt_agree = np.argmax(qt, -1) == np.argmax(q_qt, -1)
+    tags, q_tags = np.argmax(ep, -1), np.argmax(q_ep, -1)
+    ep_agree = [np.array_equal(tags[i, :n], q_tags[i, :n]) for i, n in enumerate(lengths)]
+    print("%d questions" % len(questions))
+    print("Question type agreement: %.4f" % np.mean(qt_agree))
+    print("EP spans agreement (all tags of the question): %.4f" % np.mean(ep_agree))
+
+    # single question latency
+    for name, e, path in [('float32', engine, engine_path), ('int8', quantized_engine, quantized_path)]:
+        times = []
+        for i in range(len(x)):
+            start = time.time()
+            e.predict(x[i:i+1])
+            times.append(time.time() - start)
+        print("%s: %.2f ms per question (p95 %.2f ms), %.1f MB in memory, %.1f MB on disk" %
+              (name, np.mean(times)*1000, np.percentile(times, 95)*1000,
+               e.nbytes() / 1e6, os.path.getsize(path) / 1e6))
+
+
+if __name__ == '__main__':
+    from request import KBQA, model_path, engine_weights, quantized_engine_weights
+    from setup import Mongo_Connector
+    quantize_weights(model_path+engine_weights, model_path+quantized_engine_weights)
+    service = KBQA(engine='numpy')
+    questions = [doc['question'] for doc in Mongo_Connector('kbqa', 'lcquad').get_sample(train=False, limit=None)]
+    report(service, service.engine, NumpyEngine(model_path+quantized_engine_weights), questions,
+           model_path+engine_weights, model_path+quantized_engine_weights)
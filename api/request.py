@@ -9,89 +9,361 @@ Created on Nov 8, 2019
 
 QA request-handling functions
 '''
+import os
+import time
+import hashlib
+import atexit
+import threading
 import pickle as pkl
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import scipy.sparse as sp
 from sklearn.preprocessing import normalize, binarize
 
-from keras.preprocessing.text import text_to_word_sequence
-
 from hdt import HDTDocument
 
 from setup import *
-from models import *
+# Keras (and TensorFlow) is imported only when the Keras models are loaded, see load_keras_models
+from text import text_to_word_sequence, question_types, decode_parses
+from vectors import vector_tables, load_vector_table, load_word_vector_table, LazyVectors
+from engine import NumpyEngine
+from cache import LRUCache
+from metrics import stage, timed, triples, pages, subgraph_entities, subgraph_edges
+from tracing import null_span
 
 # paths
 hdt_path = '/mnt/ssd/sv/'
 embeddings_path = "/home/zola/Projects/KBQA/api/resources/embeddings/"
 model_path = '/home/zola/Projects/KBQA/api/resources/models/'
 
+# question models weights exported for the NumPy engine
+engine_weights = 'kbqa_weights.npz'
+quantized_engine_weights = 'kbqa_weights_int8.npz'
+# both question models frozen into a single Keras file without the optimizer state
+frozen_model = 'kbqa_inference.h5'
+
 # KG
 hdt_file = 'dbpedia2016-04en.hdt'
 namespace = 'predef-dbpedia2016-04'
 
 embeddings_choice='glove840B300d'
-question_types = ['SELECT', 'ASK', 'COUNT']
+
+# number of candidates per span: entities from the index and similar predicate labels
+cutoffs = (500, 500)
+# degradations under a latency budget (see Budget), triggered by the fraction of the budget spent when the stage starts
+degraded_cutoffs = (100, 50)
+cutoffs_pressure = 0.5
+hop2_pressure = 0.8
 
 
 class KBQA():
-    def __init__(self, dataset_name='lcquad'):
+    def __init__(self, dataset_name='lcquad', fused=True, shared_encoder_weights=None, bucket_lengths=None, batch_size=32, oov_fallback=True, engine='keras',
+                 parse_cache_size=10000, parse_cache_path=None,
+                 intra_op_threads=None, inter_op_threads=None, cpu_affinity=None, warm_up=True, frozen=True,
+                 parallel=True, wait=True):
         '''
         Setup models, indices, embeddings and connection to the KG through the HDT API
+        fused -- run both question models in a single graph with one predict call
+        shared_encoder_weights -- checkpoint of a retrained model with a shared encoder (see build_shared_encoder_model)
+        bucket_lengths -- pad questions only up to the closest of these lengths instead of max_len, e.g. [10, 15]
+        (validate the buckets against the padded path with check_buckets)
+        batch_size -- default number of questions per batch in the neural front-end
+        oov_fallback -- embed words missing from the exported word vectors with Magnitude (otherwise zero vectors)
+        engine -- 'keras', 'numpy' to run the question models without TensorFlow
+        or 'numpy-int8' with the quantized weights (quantize.py)
+        (export the frozen models and the NumPy weights with export.py)
+        parse_cache_size -- number of parsed questions kept in memory (0 to disable the cache)
+        parse_cache_path -- pickle file to restore the parse cache from at startup and to save it to at exit
+        intra_op_threads, inter_op_threads -- threads of the TensorFlow session (the defaults use all cores)
+        cpu_affinity -- cores to pin this process to, e.g. one replica per worker process on its own cores
+        (the NumPy engines use the BLAS threads, set OMP_NUM_THREADS before starting the worker)
+        warm_up -- run a dummy batch through the models at startup, so that the first request is not slower
+        frozen -- load the frozen Keras model when it was exported instead of rebuilding the models
+        parallel -- load the components in parallel threads
+        wait -- wait until all components are loaded, otherwise check ready or status
         '''
+        self.batch_size = batch_size
+        # seconds spent loading each component
+        self.load_times = {}
+        self.start_time = time.time()
+        if cpu_affinity:
+            os.sched_setaffinity(0, cpu_affinity)
         
+        # load settings of the pre-trained question type classification and question parsing models
+        with open(model_path+'qtype_lcquad_%s.pkl'%(embeddings_choice), 'rb') as f:
+            self.model_settings = pkl.load(f)
+        with open(model_path+'lcquad_%s.pkl'%(embeddings_choice), 'rb') as f:
+            self.ep_model_settings = pkl.load(f)
+        # the recurrent layers do not depend on the sequence length: bucketed models share the weights
+        self.bucket_lengths = None
+        if bucket_lengths:
+            self.bucket_lengths = sorted(set(min(l, self.model_settings['max_len']) for l in bucket_lengths) | {self.model_settings['max_len']})
+
+        self.engine = None
+        self.fused_model = None
+        self.graph, self.session = None, None
+        self.p_vectors = None
+
+        # Elasticsearch requests overlapping with local work
+        self.io_pool = ThreadPoolExecutor(4)
+        self.kg_lock = threading.Lock()
+
+        # questions with the same tokens (case, punctuation and whitespace variants) share the parse
+        self.parse_cache = None
+        if parse_cache_size:
+            version = self.parse_version(engine, fused, shared_encoder_weights, oov_fallback)
+            self.parse_cache = LRUCache(parse_cache_size, parse_cache_path, version=version, name='parse')
+            if parse_cache_path:
+                atexit.register(self.parse_cache.save)
+
+        # the components are loaded in parallel threads (Elasticsearch scan, memory maps, HDT and weights files)
+        components = OrderedDict([
+            ('indices', (self.load_indices, ())),
+            ('vectors', (self.load_vectors, ())),
+            ('models', (self.load_models, (engine, fused, shared_encoder_weights, intra_op_threads, inter_op_threads, frozen, warm_up))),
+            ('kg', (self.load_kg, ())),
+            ('fallbacks', (self.load_fallbacks, (oov_fallback,)))])
+        self.load_errors = {}
+        self.loading = OrderedDict()
+        pool = ThreadPoolExecutor(len(components) if parallel else 1)
+        for name, (loader, args) in components.items():
+            self.loading[name] = pool.submit(self.load_component, name, loader, *args)
+        pool.shutdown(wait=False)
+        if wait:
+            self.wait_ready()
+
+    # questions can be answered without these (see ready)
+    optional_components = ['fallbacks']
+
+    def load_indices(self):
         # connect to the entity and predicate catalogs
         self.e_index = IndexSearch('dbpedia201604e')
         self.p_index = IndexSearch('dbpedia201604p')
+        # keep the predicate catalog in memory for relation detection
+        self.p_labels = LabelTable(self.p_index)
 
-        # load embeddings
-        self.word_vectors = load_embeddings(embeddings_path, embeddings_choice)
+    def load_vectors(self):
+        # question words are embedded from the exported table (see vectors.py)
+        self.word_vectors = load_word_vector_table(embeddings_path, embeddings_choice)
+        # exported predicate label vectors (see vectors.py)
+        self.p_similarity = load_vector_table(embeddings_path, 'fasttext_p_labels')
+
+    def load_fallbacks(self, oov_fallback=True):
+        '''
+        Magnitude is used only for the words and spans missing from the exported vectors (otherwise zero vectors)
+        '''
+        word_vectors = load_embeddings(embeddings_path, embeddings_choice) if oov_fallback else None
         self.p_vectors = load_embeddings(embeddings_path, 'fasttext_p_labels')
-        
+        self.loading['vectors'].result()
+        self.word_vectors.fallback = word_vectors
+        self.p_similarity.fallback = self.p_vectors
+
+    def load_models(self, engine, fused, shared_encoder_weights, intra_op_threads, inter_op_threads, frozen, warm_up):
+        weights = {'numpy': engine_weights, 'numpy-int8': quantized_engine_weights}.get(engine)
+        if weights and not os.path.exists(model_path+weights):
+            print("%s not exported (see export.py), falling back to the Keras models" % (model_path+weights))
+            engine = 'keras'
+        if engine == 'numpy':
+            # forward pass in NumPy over the exported weights (see export.py)
+            self.engine = NumpyEngine(model_path+engine_weights)
+        elif engine == 'numpy-int8':
+            # int8 kernels (see quantize.py)
+            self.engine = NumpyEngine(model_path+quantized_engine_weights)
+        else:
+            self.load_keras_models(fused, shared_encoder_weights, intra_op_threads, inter_op_threads, frozen)
+        if warm_up:
+            with self.timed('warm-up'):
+                self.warm_up()
+
+    def load_kg(self):
+        # connect to the knowledge graph hdt file
+        self.kg = HDTDocument(hdt_path+hdt_file)
+
+    def load_component(self, name, loader, *args):
+        try:
+            with self.timed(name):
+                loader(*args)
+        except Exception as e:
+            self.load_errors[name] = e
+            print("Failed to load %s: %r" % (name, e))
+            raise
+        print("Loaded %s in %.2fs" % (name, self.load_times[name]))
+
+    def ready(self, required_only=False):
+        '''
+        All components loaded, or only the ones required to answer questions
+        '''
+        return all(future.done() and name not in self.load_errors for name, future in self.loading.items()
+                   if not (required_only and name in self.optional_components))
+
+    def fallbacks_missing(self):
+        '''
+        The Magnitude fallbacks are still loading (or failed to load): OOV words and spans get zero vectors
+        '''
+        return not self.loading['fallbacks'].done() or 'fallbacks' in self.load_errors
+
+    def wait_ready(self):
+        '''
+        Wait for all components, fails as soon as one of them could not be loaded
+        '''
+        futures.wait(self.loading.values(), return_when=futures.FIRST_EXCEPTION)
+        for future in self.loading.values():
+            if future.done() and future.exception():
+                raise future.exception()
+        print("Loaded in %.2fs: %s" % (time.time() - self.start_time,
+                                       ", ".join("%s %.2fs" % (c, t) for c, t in self.load_times.items())))
+
+    def status(self):
+        '''
+        Load status and time of every component
+        '''
+        return {name: {'loaded': future.done() and name not in self.load_errors,
+                       'optional': name in self.optional_components,
+                       'seconds': self.load_times.get(name),
+                       'error': repr(self.load_errors[name]) if name in self.load_errors else None}
+                for name, future in self.loading.items()}
+
+    def fingerprint(self):
+        '''
+        Version of everything the answers depend on: the HDT file, the Elasticsearch indices, the model files and
+        the exported vectors (see AnswerCache)
+        '''
+        files = [hdt_path+hdt_file] + [model_path+name for name in sorted(os.listdir(model_path))]
+        files += [embeddings_path+vector_tables[name]+extension for name in ['fasttext_p_labels', embeddings_choice]
+                  for extension in ['.npy', '.vocab']]
+        state = [(path, os.path.getmtime(path), os.path.getsize(path)) for path in files if os.path.exists(path)]
+        for index in [self.e_index, self.p_index]:
+            # the uuid changes when the index is rebuilt
+            settings = list(index.es.indices.get_settings(index=index.index).values())[0]
+            state.append((index.index, settings['settings']['index']['uuid'], index.es.count(index=index.index)['count']))
+        return hashlib.md5(repr(state).encode('utf-8')).hexdigest()
+
+    def parse_version(self, engine, fused, shared_encoder_weights, oov_fallback):
+        '''
+        Version of everything the parses depend on: the model, weights and export files, the exported word vectors
+        and the front-end options (see parse_cache)
+        '''
+        files = [model_path+name for name in sorted(os.listdir(model_path))]
+        files += [embeddings_path+vector_tables[embeddings_choice]+extension for extension in ['.npy', '.vocab']]
+        if shared_encoder_weights:
+            files += [shared_encoder_weights, model_path+shared_encoder_weights]
+        state = [(path, os.path.getmtime(path), os.path.getsize(path)) for path in files if os.path.isfile(path)]
+        state.append((engine, embeddings_choice, fused, shared_encoder_weights, oov_fallback, self.bucket_lengths))
+        return hashlib.md5(repr(state).encode('utf-8')).hexdigest()
+
+    def after_fork(self, fallbacks=True):
+        '''
+        Reopen what cannot be shared with a forked process: connections, threads and locks
+        The read-only arrays (exported vectors and weights, catalogs, HDT mapping) stay shared copy-on-write
+        fallbacks -- open the Magnitude fallbacks for OOV words in this process when needed, otherwise zero vectors
+        '''
+        self.e_index = IndexSearch(self.e_index.index)
+        self.p_index = IndexSearch(self.p_index.index)
+        # the Magnitude connections are not shared: every worker opens its own on the first OOV word
+        if not fallbacks:
+            self.word_vectors.fallback = self.p_vectors = self.p_similarity.fallback = None
+        if self.word_vectors.fallback is not None:
+            self.word_vectors.fallback = LazyVectors(lambda: load_embeddings(embeddings_path, embeddings_choice))
+        if self.p_vectors is not None:
+            self.p_vectors = LazyVectors(lambda: load_embeddings(embeddings_path, 'fasttext_p_labels'))
+            self.p_similarity.fallback = self.p_vectors
+        self.io_pool = ThreadPoolExecutor(4)
+        self.kg_lock = threading.Lock()
+        if self.parse_cache is not None:
+            self.parse_cache.lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, component):
+        start = time.time()
+        yield
+        self.load_times[component] = time.time() - start
+
+    def load_keras_models(self, fused=True, shared_encoder_weights=None, intra_op_threads=None, inter_op_threads=None, frozen=True):
+        '''
+        Load the Keras models into a graph and a session owned by this instance
+        '''
+        import tensorflow as tf
+        from keras import backend as K
+        # 0 lets TensorFlow pick the number of threads
+        config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads or 0,
+                                inter_op_parallelism_threads=inter_op_threads or 0)
+        self.graph = tf.Graph()
+        self.session = tf.Session(graph=self.graph, config=config)
+        with self.keras_session():
+            K.set_session(self.session)
+            self.build_keras_models(fused, shared_encoder_weights, frozen)
+
+    @contextmanager
+    def keras_session(self):
+        '''
+        Use the graph and the session of the Keras models, e.g. to call them from another thread
+        '''
+        with self.graph.as_default(), self.session.as_default():
+            yield
+
+    def build_keras_models(self, fused=True, shared_encoder_weights=None, frozen=True):
+        from models import build_qt_inference_model, build_ep_inference_model, build_fused_inference_model, \
+            build_shared_encoder_model, load_inference_model
+        variable_length = bool(self.bucket_lengths)
+        # the frozen model (see export.py) is loaded as is: no rebuild and no compile
+        if frozen and fused and not variable_length and not shared_encoder_weights and os.path.exists(model_path+frozen_model):
+            self.fused_model = load_inference_model(model_path+frozen_model)
+            self.qt_model = self.fused_model.get_layer('qt')
+            self.ep_model = self.fused_model.get_layer('ep')
+            return
+
         # load pre-trained question type classification model
-        with open(model_path+'qtype_lcquad_%s.pkl'%(embeddings_choice), 'rb') as f:
-            self.model_settings = pkl.load(f)
-        self.qt_model = build_qt_inference_model(self.model_settings)
+        self.qt_model = build_qt_inference_model(self.model_settings, variable_length, compile=False)
         self.qt_model.load_weights(model_path+'_qtype_weights.best.hdf5', by_name=True)
 
         # load pre-trained question parsing model
-        with open(model_path+'lcquad_%s.pkl'%(embeddings_choice), 'rb') as f:
-            ep_model_settings = pkl.load(f)
-        self.ep_model = build_ep_inference_model(ep_model_settings)
+        self.ep_model = build_ep_inference_model(self.ep_model_settings, variable_length, compile=False)
         # load weights
         # ep_model.load_weights('checkpoints/_'+modelname+'_weights.best.hdf5', by_name=True)
         self.ep_model.load_weights(model_path+'2hops-types.h5', by_name=True)
 
-        # connect to the knowledge graph hdt file
-        self.kg = HDTDocument(hdt_path+hdt_file)
+        # run both models in a single graph
+        if shared_encoder_weights:
+            self.fused_model = build_shared_encoder_model(self.model_settings, self.ep_model_settings, variable_length, compile=False)
+            self.fused_model.load_weights(model_path+shared_encoder_weights, by_name=True)
+        elif fused:
+            self.fused_model = build_fused_inference_model(self.qt_model, self.ep_model)
 
     # functions for entity linking and relation detection
+    @timed('entity_linking')
     def entity_linking(self, e_spans, verbose=False, cutoff=500, threshold=0): 
-        guessed_ids = []
-        for span in e_spans:
-            span_ids = self.e_index.label_scores(span, top=cutoff, threshold=threshold, verbose=verbose, scale=0.3, max_degree=50000)
-            guessed_ids.append(span_ids)
-        return guessed_ids
+        # query all spans in one round trip
+        return self.e_index.label_scores_batch(e_spans, top=cutoff, threshold=threshold, verbose=verbose, scale=0.3, max_degree=50000)
 
+    @timed('relation_detection')
     def relation_detection(self, p_spans, verbose=False, cutoff=500, threshold=0.0): 
+        '''
+        cutoff -- number of similar labels for all spans or a list with the number of labels for each span
+        '''
+        if not p_spans:
+            return []
+        cutoffs = cutoff if isinstance(cutoff, list) else [cutoff] * len(p_spans)
         guessed_ids = []
-        for span in p_spans:
-            span_ids = {}
+        # score all spans against the predicate labels at once
+        for span, cutoff, (exact_match, similar) in zip(p_spans, cutoffs, self.p_similarity.most_similar(p_spans, topn=max(cutoffs))):
             guessed_labels = []
-            if span in self.p_vectors:
+            if exact_match:
                 guessed_labels.append([span, 1])
-            for p, score in self.p_vectors.most_similar(span, topn=cutoff):
+            for p, score in similar[:cutoff]:
                 if score >= threshold:
                     guessed_labels.append([p, score])
-            for label, score in guessed_labels:
-                for match in self.p_index.look_up_by_label(label):
-                    _id = match['_source']['id']
-                    span_ids[_id] = score
-                    if verbose:
-                        uri = match['_source']['uri']
-                        print(uri)
-                        print(score)
+            # look up predicate ids for all guessed labels at once
+            labels = [label for label, score in guessed_labels]
+            scores = np.array([score for label, score in guessed_labels])
+            positions, owners = self.p_labels.look_up_by_labels(labels)
+            span_ids = dict(zip(self.p_labels.ids[positions].tolist(), scores[owners].tolist()))
+            if verbose:
+                for uri, score in zip(self.p_labels.uris[positions], scores[owners]):
+                    print(uri)
+                    print(score)
             guessed_ids.append(span_ids)
         return guessed_ids
 
@@ -123,10 +395,12 @@ class KBQA():
         
         return np.asarray(sp_adjacencies)
 
-    def hop(self, entities, constraints, top_predicates, verbose=False, max_triples=500000, bl_p=[68655]):
+    def hop(self, entities, constraints, top_predicates, verbose=False, max_triples=500000, bl_p=[68655], budget=None, trace=null_span):
         '''
         Extract the subgraph for the selected entities
         bl_p  -- the list of predicates to ignore (e.g. type predicate is too expensive to expand)
+        budget -- stop paging through the subgraph partitions when the deadline has passed
+        trace -- span the subgraph partitions are recorded in
         ''' 
     #     print(top_predicates)
         n_constraints = len(constraints)
@@ -142,10 +416,18 @@ class KBQA():
         offset = 0
 
         while True:
+            # answer from the partitions processed so far
+            if offset and budget is not None and budget.expired():
+                budget.degrade('kg_paging_stopped')
+                return [{a_id: a_score} for a_id, a_score in activations.items()]
+
             # get the subgraph for selected predicates only
     #         print(top_predicates_ids)
-            self.kg.configure_hops(1, top_predicates_ids, namespace, True)
-            entities, predicate_ids, adjacencies = self.kg.compute_hops(all_entities_ids, max_triples, offset)
+            # the hops configuration is stored in the HDT document: one extraction at a time
+            page_start = time.time()
+            with self.kg_lock:
+                self.kg.configure_hops(1, top_predicates_ids, namespace, True)
+                entities, predicate_ids, adjacencies = self.kg.compute_hops(all_entities_ids, max_triples, offset)
     #         print(adjacencies)
             # show subgraph entities
     #         print([e_index.look_up_by_id(e)[0]['_source']['uri'] for e in entities])
@@ -154,6 +436,13 @@ class KBQA():
                 answers = [{a_id: a_score} for a_id, a_score in activations.items()]
                 return answers
 
+            n_triples = sum(len(edges) for edges in adjacencies)
+            trace.add('page', page_start, time.time(), offset=offset, entities=len(entities), triples=n_triples)
+            pages.inc()
+            triples.inc(n_triples)
+            subgraph_entities.observe(len(entities))
+            subgraph_edges.observe(n_triples)
+
             if verbose:
                 print("Subgraph extracted:")
                 print("%d entities"%len(entities))
@@ -239,42 +528,199 @@ class KBQA():
                         if e in activations1:
                             activations[e] += y[i]
 
-    def request(self, question, top_n=3, verbose=False):
-        # parse question into words and embed
-        x_test_sent = np.zeros((self.model_settings['max_len'], self.model_settings['emb_dim']))
-        q_words = text_to_word_sequence(question)
-        for i, word in enumerate(q_words):
-            x_test_sent[i] = self.word_vectors.query(word)
+    def tokenize(self, question):
+        '''
+        Canonical form of the question: the tuple of words seen by the models
+        '''
+        return tuple(text_to_word_sequence(question)[:self.model_settings['max_len']])
 
-        # predict question type
-        if verbose:
-            print(x_test_sent)
-        y_p = self.qt_model.predict(np.array([x_test_sent]))
-        y_p = np.argmax(y_p, axis=-1)[0]
-        p_qt = question_types[y_p]
+    def embed(self, questions):
+        '''
+        Tokenize and embed a batch of questions into a zero-padded array
+        '''
+        q_words = [self.tokenize(question) for question in questions]
+        return self.embed_words(q_words), q_words
+
+    def embed_words(self, q_words):
+        # look up all words of the batch at once
+        return self.word_vectors.query(q_words, pad_to_length=self.model_settings['max_len'])
+
+    def _predict(self, x):
+        if self.engine:
+            x = np.asarray(x, dtype=np.float32)
+            with stage('qtype'):
+                y_qt = self.engine.predict_question_types(x)
+            with stage('span_tagging'):
+                y_ep = self.engine.one_hot(self.engine.predict_tags(x))
+            return y_qt, y_ep
+        with self.keras_session():
+            if self.fused_model:
+                # both models in a single call
+                with stage('qtype+span_tagging'):
+                    return self.fused_model.predict(x, batch_size=len(x))
+            with stage('qtype'):
+                y_qt = self.qt_model.predict(x, batch_size=len(x))
+            with stage('span_tagging'):
+                y_ep = self.ep_model.predict(x, batch_size=len(x))
+            return y_qt, y_ep
+
+    def warm_up(self):
+        '''
+        Run a batch of zeros for every input length: builds the predict functions and selects the kernels
+        (or pages in the NumPy weights) before the first request
+        '''
+        max_len = self.model_settings['max_len']
+        x = np.zeros((self.batch_size, max_len, self.model_settings['emb_dim']), dtype=np.float32)
+        for length in self.bucket_lengths or [max_len]:
+            self.predict(x, [length] * len(x))
+
+    def predict(self, x, lengths=None):
+        '''
+        Run the question type and the EP spans models on a batch of embedded questions
+        lengths -- number of words in each question to group the batch by length buckets
+        '''
+        if not self.bucket_lengths or lengths is None:
+            return self._predict(x)
+        y_qt, y_ep = None, None
+        # smallest bucket that fits each question
+        buckets = np.searchsorted(self.bucket_lengths, np.minimum(lengths, x.shape[1]))
+        for bucket in np.unique(buckets):
+            rows = np.flatnonzero(buckets == bucket)
+            bucket_length = self.bucket_lengths[bucket]
+            qt, ep = self._predict(x[rows, :bucket_length])
+            if y_qt is None:
+                y_qt = np.zeros((len(x),) + qt.shape[1:], dtype=qt.dtype)
+                y_ep = np.zeros((len(x), x.shape[1]) + ep.shape[2:], dtype=ep.dtype)
+            y_qt[rows] = qt
+            y_ep[rows, :bucket_length] = ep
+        return y_qt, y_ep
+
+    def check_buckets(self, questions):
+        '''
+        Compare the predictions with length buckets against the predictions padded to max_len
+        '''
+        x, q_words = self.embed(questions)
+        lengths = [len(words) for words in q_words]
+        qt, ep = self.predict(x)
+        b_qt, b_ep = self.predict(x, lengths)
+        qt_agree = np.argmax(qt, axis=-1) == np.argmax(b_qt, axis=-1)
+        ep_agree = [np.array_equal(np.argmax(ep[i, :n], axis=-1), np.argmax(b_ep[i, :n], axis=-1)) for i, n in enumerate(lengths)]
+        print("Question type agreement: %.4f" % np.mean(qt_agree))
+        print("EP spans agreement: %.4f" % np.mean(ep_agree))
+        return np.mean(qt_agree), np.mean(ep_agree)
+
+    def parse(self, questions, batch_size=None):
+        '''
+        Neural front-end: predict the question type and the EP spans for a list of questions
+        (the parses are cached by the question tokens, see tokenize)
+        batch_size -- number of questions embedded and passed through the models at once
+        '''
+        batch_size = batch_size or self.batch_size
+        # parse questions into words
+        keys = [self.tokenize(question) for question in questions]
+        parses = {}
+        for key in keys:
+            if key not in parses:
+                parses[key] = self.parse_cache.get(key) if self.parse_cache is not None else None
+        # only the distinct questions missing from the cache go through the models
+        missing = [key for key, parse in parses.items() if parse is None]
+        for i in range(0, len(missing), batch_size):
+            q_words = missing[i:i+batch_size]
+            # checked before embedding: the fallbacks may finish loading meanwhile
+            fallbacks_missing = self.fallbacks_missing()
+            with stage('embed'):
+                x = self.embed_words(q_words)
+            y_qt, y_ep = self.predict(x, [len(words) for words in q_words])
+            # decode the whole batch
+            for words, parse in zip(q_words, decode_parses(q_words, y_qt, y_ep)):
+                parses[words] = parse
+                if fallbacks_missing and any(word not in self.word_vectors for word in words):
+                    # zero vectors for the OOV words: reported with the answer and not cached
+                    parses[words]['degradations'] = ['oov_fallback_missing']
+                elif self.parse_cache is not None:
+                    self.parse_cache.put(words, parses[words])
+        return [parses[key] for key in keys]
+
+    def request(self, question, top_n=3, verbose=False, budget=None, trace=null_span):
+        '''
+        budget -- Budget of the request, the degradations applied are recorded in budget.degradations
+        trace -- span the stages of the request are recorded in (see tracing.py)
+        '''
+        with trace.span('parse'):
+            parse = self.parse([question])[0]
+        with trace.span('link'):
+            links = self.link([parse], [budget])[0]
+        return self.answer(parse, top_n, verbose, links, budget, trace)
+
+    def request_batch(self, questions, top_n=3, verbose=False, batch_size=None):
+        parses = self.parse(questions, batch_size)
+        return [self.answer(parse, top_n, verbose, links) for parse, links in zip(parses, self.link(parses))]
+
+    def cutoffs(self, budget=None):
+        '''
+        Number of candidate entities and predicate labels per span: fewer when a large part of the budget is spent
+        '''
+        if budget is not None and budget.pressure() >= cutoffs_pressure:
+            budget.degrade('cutoffs_reduced')
+            return degraded_cutoffs
+        return cutoffs
+
+    def link(self, parses, budgets=None):
+        '''
+        Entity linking and relation detection for a batch of parsed questions: the distinct spans of all questions are matched at once
+        budgets -- Budget of every question (optional)
+        Returns for every question the ids matched for e_spans1, p_spans1 and p_spans2
+        '''
+        question_cutoffs = [self.cutoffs(budget) for budget in budgets or [None] * len(parses)]
+        # distinct (span, cutoff) pairs
+        e_spans = list(dict.fromkeys((span, e_cutoff) for parse, (e_cutoff, _) in zip(parses, question_cutoffs) for span in parse['e_spans1']))
+        p_spans = list(dict.fromkeys((span, p_cutoff) for parse, (_, p_cutoff) in zip(parses, question_cutoffs) for span in parse['p_spans1'] + parse['p_spans2']))
+        # wait for Elasticsearch while the predicates are matched locally
+        e_ids = self.io_pool.submit(self.entity_linking, [span for span, _ in e_spans], False, [cutoff for _, cutoff in e_spans], 0.7)
+        p_ids = dict(zip(p_spans, self.relation_detection([span for span, _ in p_spans], False, [cutoff for _, cutoff in p_spans], 0)))
+        e_ids = dict(zip(e_spans, e_ids.result()))
+        return [([e_ids[(span, e_cutoff)] for span in parse['e_spans1']],
+                 [p_ids[(span, p_cutoff)] for span in parse['p_spans1']],
+                 [p_ids[(span, p_cutoff)] for span in parse['p_spans2']]) for parse, (e_cutoff, p_cutoff) in zip(parses, question_cutoffs)]
+
+    def answer(self, parse, top_n=3, verbose=False, links=None, budget=None, trace=null_span):
+        '''
+        Answer a parsed question: link the spans and run MP over the KG
+        links -- the output of link for this question when the spans were already linked in a batch
+        budget -- Budget of the request
+        trace -- span the stages and candidate counts are recorded in, with the spans and ids if trace.payloads
+        '''
+        p_qt = parse['question_type']
         ask_question = p_qt == 'ASK'
-        print(p_qt)
 
         # use GS spans + preprocess
-        y_p = self.ep_model.predict(np.array([x_test_sent]))
-        y_p = np.argmax(y_p, axis=-1)[0]
-        e_spans1 = collect_mentions(q_words, y_p, 1)
-        p_spans1 = collect_mentions(q_words, y_p, 2)
-        p_spans2 = collect_mentions(q_words, y_p, 3)
+        e_spans1, p_spans1, p_spans2 = parse['e_spans1'], parse['p_spans1'], parse['p_spans2']
 
         #         c_spans1 = doc['c1_spans']
         #         c_spans2 = doc['c2_spans']
 
-        # match predicates
-        top_predicates_ids1 = self.relation_detection(p_spans1, threshold=0)
-        top_predicates_ids2 = self.relation_detection(p_spans2, threshold=0)
+        # match entities and predicates for both hops
+        top_entities_ids1, top_predicates_ids1, top_predicates_ids2 = links or self.link([parse], [budget])[0]
+        if budget is not None:
+            for degradation in parse.get('degradations', []):
+                budget.degrade(degradation)
+            # no similar predicates for the OOV spans without the fallback
+            if self.fallbacks_missing() and any(span not in self.p_similarity for span in p_spans1 + p_spans2):
+                budget.degrade('oov_fallback_missing')
+        trace.set(question_type=p_qt,
+                  entity_candidates=[len(ids) for ids in top_entities_ids1],
+                  predicate_candidates1=[len(ids) for ids in top_predicates_ids1],
+                  predicate_candidates2=[len(ids) for ids in top_predicates_ids2])
+        if trace.payloads:
+            trace.set(e_spans1=e_spans1, p_spans1=p_spans1, p_spans2=p_spans2,
+                      entities=self.top_ids(top_entities_ids1, top_n),
+                      predicates1=self.top_ids(top_predicates_ids1, top_n),
+                      predicates2=self.top_ids(top_predicates_ids2, top_n))
 
         # use GS classes
         #         classes1 = [{_id: 1} for _id in doc['classes_ids'] if _id in doc['1hop_ids'][0]]
         #         classes2 = [{_id: 1} for _id in doc['classes_ids'] if _id in doc['2hop_ids'][0]]
 
-        top_entities_ids1 = self.entity_linking(e_spans1, threshold=0.7)
-
         if ask_question:
             a_threshold = 0.0
         else:
@@ -284,52 +730,85 @@ class KBQA():
         answers_ids = []
 
         # 1st hop
-        answers_ids1 = self.hop([], top_entities_ids1, top_predicates_ids1, verbose)
+        with stage('hop1'), trace.span('hop1') as span:
+            answers_ids1 = self.hop([], top_entities_ids1, top_predicates_ids1, verbose, budget=budget, trace=span)
         #         if classes1:
         #             answers_ids1 = filter_answer_by_class(classes1, answers_ids1)
         answers1 = [{a_id: a_score} for activations in answers_ids1 for a_id, a_score in activations.items() if a_score > a_threshold]
+        span.set(answers=len(answers1))
 
         # 2nd hop
-        if top_predicates_ids1 and top_predicates_ids2:                
-            answers_ids = self.hop(answers1, [], top_predicates_ids2, verbose)
+        if top_predicates_ids1 and top_predicates_ids2 and budget is not None and budget.pressure() >= hop2_pressure:
+            # the entities of the 1st hop are not the answers: no answers (False for ASK), the degradation tells why
+            budget.degrade('hop2_skipped')
+            if verbose:
+                print(self.resolve(self.e_index, answers1, top_n))
+            return False if ask_question else []
+        elif top_predicates_ids1 and top_predicates_ids2:                
+            with stage('hop2'), trace.span('hop2') as span:
+                answers_ids = self.hop(answers1, [], top_predicates_ids2, verbose, budget=budget, trace=span)
         #             if classes2:
         #                 answers_ids = filter_answer_by_class(classes2, answers_ids)
             answers = [{a_id: a_score} for activations in answers_ids for a_id, a_score in activations.items() if a_score > a_threshold]
+            span.set(answers=len(answers))
+            if trace.payloads:
+                trace.set(intermediate_answers=self.top_ids(answers1, top_n))
         else:
             answers = answers1
 
         answers_ids = [_id for a in answers for _id in a]
 
+        if verbose:
+            # the diagnostics cost extra Elasticsearch look ups: only when asked for
+            print(p_qt)
+            print(e_spans1)
+            print(p_spans1)
+            print(p_spans2)
+            print(self.resolve(self.e_index, top_entities_ids1, top_n))
+            print(self.resolve(self.p_index, top_predicates_ids1, top_n))
+            print(self.resolve(self.p_index, top_predicates_ids2, top_n))
+            # show intermediate answers if there was a second hop
+            if top_predicates_ids2:
+                print(self.resolve(self.e_index, answers1, top_n))
+
+        with stage('answer_resolution'), trace.span('answer_resolution') as span:
+            if ask_question:
+                # make sure the output matches every input basket
+                all_entities_baskets = [set(e.keys()) for e in top_entities_ids1]
+                answers = all(x & set(answers_ids) for x in all_entities_baskets)
+            else:
+                if trace.payloads:
+                    trace.set(answers=self.top_ids(answers, top_n))
+                # show answers
+                answers = self.resolve(self.e_index, answers, top_n)
+                span.set(answers=len(answers))
 
-        # show spans
-        print(e_spans1)
-        print(p_spans1)
-        print(p_spans2)
-
-        # show  matches
-        print([{self.e_index.look_up_by_id(_id)[0]['_source']['uri']: score} for answer in top_entities_ids1 for _id, score in answer.items() if self.e_index.look_up_by_id(_id)][:top_n])
-        print([{self.p_index.look_up_by_id(_id)[0]['_source']['uri']: score} for answer in top_predicates_ids1 for _id, score in answer.items() if self.p_index.look_up_by_id(_id)][:top_n])
-        print([{self.p_index.look_up_by_id(_id)[0]['_source']['uri']: score} for answer in top_predicates_ids2 for _id, score in answer.items() if self.p_index.look_up_by_id(_id)][:top_n])
-
-
-        # show intermediate answers if there was a second hop
-        if top_predicates_ids2:
-            print([{self.e_index.look_up_by_id(_id)[0]['_source']['uri']: score} for answer in answers1 for _id, score in answer.items() if self.e_index.look_up_by_id(_id)][:top_n])
-
-
-        if ask_question:
-            # make sure the output matches every input basket
-            all_entities_baskets = [set(e.keys()) for e in top_entities_ids1]
-            answers = all(x & set(answers_ids) for x in all_entities_baskets)
-        else:
-            # show answers
-            answers = [{self.e_index.look_up_by_id(_id)[0]['_source']['uri']: score} for answer in answers for _id, score in answer.items() if self.e_index.look_up_by_id(_id)][:top_n]
-        
         if verbose:
             print(answers)
 
         return answers
 
+    def top_ids(self, matches, top_n=3):
+        '''
+        First top_n {id: score} of the matches, the ids are not resolved
+        '''
+        return [{_id: score} for match in matches for _id, score in match.items()][:top_n]
+
+    def resolve(self, index, matches, top_n=3, chunk_size=100):
+        '''
+        First top_n matches found in the index as {uri: score}: batch look ups of the ids in order, instead of a look up per id,
+        until top_n are found
+        '''
+        matches = [(_id, score) for match in matches for _id, score in match.items()]
+        resolved = []
+        for i in range(0, len(matches), chunk_size):
+            chunk = matches[i:i+chunk_size]
+            uris = {doc['_source']['id']: doc['_source']['uri'] for doc in index.look_up_by_ids({_id for _id, _ in chunk}, fields=['id', 'uri'])}
+            resolved.extend({uris[_id]: score} for _id, score in chunk if _id in uris)
+            if len(resolved) >= top_n:
+                break
+        return resolved[:top_n]
+
     def test_request(self):
         question = "What are some other works of the author of The Phantom of the Opera?"
         self.request(question, verbose=True)
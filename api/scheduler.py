@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Micro-batching scheduler between the API and KBQA: concurrent requests are collected into batches for the
+neural front-end and entity linking, MP runs per question on a pool of worker threads
+'''
+import os
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from budget import Budget
+from tracing import null_span
+
+
+class QueueFull(Exception):
+    pass
+
+
+class MicroBatchScheduler:
+
+    def __init__(self, service, max_batch_size=32, max_wait_ms=10, max_queue_size=1000, mp_workers=4, max_answering=16, window=10000):
+        '''
+        service -- KBQA instance
+        max_batch_size -- maximum number of questions parsed and linked together
+        max_wait_ms -- how long the first request of a batch waits for more requests
+        max_queue_size -- requests waiting to be scheduled or answered, submit raises QueueFull beyond that
+        mp_workers -- threads answering the linked questions
+        max_answering -- linked questions waiting for or running on the MP workers, the scheduler waits beyond that
+        window -- number of the most recent requests the metrics are computed on
+        '''
+        self.service = service
+        self.pid = os.getpid()
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.max_queue_size = max_queue_size
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.pool = ThreadPoolExecutor(mp_workers)
+        # the work queue of the pool is unbounded: the linked questions handed to it are bounded here
+        self.answer_slots = threading.BoundedSemaphore(max_answering)
+        self.answering = 0
+        # metrics
+        self.queue_times = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.processed = 0
+        # requests turned away with QueueFull
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def submit(self, question, top_n=3, verbose=False, budget=None, trace=null_span):
+        '''
+        Schedule a question: returns a future with {'answers': ..., 'degradations': [...]}
+        budget -- Budget of the request, the time spent in the queue counts
+        trace -- span the queue time and the stages of the request are recorded in
+        '''
+        future = Future()
+        try:
+            if self.full():
+                raise queue.Full
+            self.queue.put_nowait((question, top_n, verbose, budget, trace, time.time(), future))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            raise QueueFull("%d requests are waiting" % (self.queue.qsize() + self.answering))
+        return future
+
+    def full(self):
+        '''
+        The requests waiting to be scheduled and the linked questions waiting to be answered reached max_queue_size
+        '''
+        return self.queue.qsize() + self.answering >= self.max_queue_size
+
+    def ask(self, question, top_n=3, verbose=False, timeout=None, budget=None, trace=null_span):
+        return self.submit(question, top_n, verbose, budget, trace).result(timeout)
+
+    def map_unordered(self, questions, top_n=3, max_in_flight=64, submit=None, budget_seconds=None):
+        '''
+        Answer an iterable of questions: yields (index, response, error) as soon as each question is answered
+        At most max_in_flight questions are scheduled at a time and scheduling waits while the queue is full
+        submit -- function scheduling a question instead of self.submit, e.g. through a cache
+        budget_seconds -- latency budget of every question from its scheduling
+        '''
+        submit = submit or self.submit
+        done = queue.Queue()
+        in_flight = 0
+        for i, question in enumerate(questions):
+            while True:
+                if in_flight >= max_in_flight:
+                    yield self.result(*done.get())
+                    in_flight -= 1
+                # backpressure: wait for our own questions or for the queue to drain before scheduling
+                if self.full():
+                    if in_flight:
+                        yield self.result(*done.get())
+                        in_flight -= 1
+                    else:
+                        time.sleep(self.max_wait)
+                    continue
+                try:
+                    future = submit(question, top_n, budget=Budget(budget_seconds))
+                    break
+                except QueueFull:
+                    # filled up by other requests in the meantime: retried, not rejected
+                    with self.lock:
+                        self.rejected -= 1
+            future.add_done_callback(lambda future, i=i: done.put((i, future)))
+            in_flight += 1
+        for _ in range(in_flight):
+            yield self.result(*done.get())
+
+    def result(self, i, future):
+        if future.exception():
+            return i, None, str(future.exception())
+        return i, future.result(), None
+
+    def collect(self):
+        '''
+        Wait for a request, then for more requests until the batch is full or max_wait has passed
+        '''
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return [item for item in batch if item is not None]
+
+    def run(self):
+        while self.running:
+            batch = self.collect()
+            if batch:
+                self.process(batch)
+
+    def process(self, batch):
+        start = time.time()
+        self.queue_times.extend(start - submitted for _, _, _, _, _, submitted, _ in batch)
+        self.batch_sizes.append(len(batch))
+        try:
+            parses = self.service.parse([question for question, _, _, _, _, _, _ in batch])
+            parsed = time.time()
+            links = self.service.link(parses, [budget for _, _, _, budget, _, _, _ in batch])
+        except Exception as e:
+            for _, _, _, _, _, _, future in batch:
+                future.set_exception(e)
+            return
+        linked = time.time()
+        for (_, top_n, verbose, budget, trace, submitted, future), parse, question_links in zip(batch, parses, links):
+            # the batch stages are shared by all its questions
+            trace.add('queue', submitted, start)
+            trace.add('parse', start, parsed, batch_size=len(batch))
+            trace.add('link', parsed, linked, batch_size=len(batch))
+            # backpressure: wait for a free slot, the requests pile up in the queue meanwhile
+            self.answer_slots.acquire()
+            with self.lock:
+                self.answering += 1
+            self.pool.submit(self.answer, future, parse, question_links, top_n, verbose, budget, trace)
+
+    def answer(self, future, parse, links, top_n, verbose, budget, trace=null_span):
+        try:
+            answers = self.service.answer(parse, top_n, verbose, links, budget, trace)
+            future.set_result({'answers': answers, 'degradations': budget.degradations if budget else []})
+        except Exception as e:
+            future.set_exception(e)
+        with self.lock:
+            self.processed += 1
+            self.answering -= 1
+        self.answer_slots.release()
+
+    def stats(self):
+        queue_times = np.array(self.queue_times or [0.]) * 1000
+        return {'queue_size': self.queue.qsize(), 'answering': self.answering, 'processed': self.processed, 'rejected': self.rejected,
+                'mean_batch_size': float(np.mean(self.batch_sizes or [0])),
+                'queue_time_ms': {'mean': float(np.mean(queue_times)), 'p50': float(np.percentile(queue_times, 50)),
+                                  'p95': float(np.percentile(queue_times, 95)), 'max': float(np.max(queue_times))}}
+
+    def shutdown(self):
+        self.running = False
+        # wake up the scheduler thread
+        self.queue.put(None)
+        self.thread.join()
+        self.pool.shutdown()
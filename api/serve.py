@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Pre-fork serving: the API and all read-only assets are loaded once in the master process, then the workers are
+forked and accept the requests on the same socket. The memory-mapped vectors, the exported weights, the catalogs
+and the HDT mapping are shared copy-on-write.
+
+python serve.py
+'''
+import os
+import gc
+import sys
+import time
+import signal
+
+from werkzeug.serving import make_server
+
+# TensorFlow sessions do not survive a fork: the NumPy engine is used by default
+os.environ.setdefault('KBQA_ENGINE', 'numpy')
+# loads the models, indices and KG in the master process
+import app as api
+
+host = '127.0.0.1'
+port = 5000
+n_workers = 4
+# seconds between the memory reports of the workers
+report_interval = 60
+# Magnitude fallbacks for OOV words, opened by a worker on its first OOV word (False: zero vectors, compare the RSS)
+worker_fallbacks = True
+
+
+def memory(pid='self'):
+    '''
+    RSS, PSS (shared pages divided between the processes) and private memory in MB
+    '''
+    values = {}
+    with open('/proc/%s/smaps_rollup' % pid) as f:
+        for line in f:
+            parse = line.split()
+            if parse[0] in ('Rss:', 'Pss:', 'Private_Clean:', 'Private_Dirty:'):
+                values[parse[0][:-1]] = int(parse[1]) / 1024.
+    return {'rss': values['Rss'], 'pss': values['Pss'], 'private': values['Private_Clean'] + values['Private_Dirty']}
+
+
+def report(master, pids):
+    print("master: RSS %.0f MB at fork, worker fallbacks %s" % (master['rss'], 'on' if worker_fallbacks else 'off'))
+    for pid in pids:
+        worker = memory(pid)
+        # private memory is what the worker added on top of the shared pages
+        print("worker %d: RSS %.0f MB, PSS %.0f MB, private %.0f MB" % (pid, worker['rss'], worker['pss'], worker['private']))
+    sys.stdout.flush()
+
+
+def serve(server):
+    api.model.after_fork(worker_fallbacks)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    # the workers share what is loaded before the fork
+    api.model.wait_ready()
+    # TensorFlow sessions do not survive a fork
+    assert api.model.engine is not None, "pre-fork serving needs a NumPy engine (see export.py)"
+    server = make_server(host, port, api.app, threaded=True)
+    # keep the garbage collector from writing to the pages of the objects loaded so far
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    master = memory()
+
+    pids = []
+    for i in range(n_workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(server)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    print("Serving on http://%s:%d with %d workers" % (host, port, n_workers))
+
+    def stop(signum, frame):
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while True:
+        time.sleep(report_interval)
+        report(master, pids)
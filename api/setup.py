@@ -15,6 +15,8 @@ from elasticsearch import Elasticsearch
 from urllib.parse import quote
 import string
 
+from metrics import es_requests
+
 class IndexSearch:
     
     def __init__(self, index_name):
@@ -24,6 +26,7 @@ class IndexSearch:
         self.type = 'terms'
 
     def match_label(self, string, top=100):
+        es_requests.inc(index=self.index, method='match_label')
         return self.es.search(index=self.index,
                               body={"query": {"multi_match": {"query": string,
 #                                                               "operator": "and",
@@ -31,38 +34,73 @@ class IndexSearch:
                                                               }}},
                               size=top, doc_type=self.type)['hits']['hits']
 
-    def label_scores(self, string, top=100, verbose=False, threshold=1.0, scale=None, max_degree=None):
-        matches = self.es.search(index=self.index,
-                              body={"query": {"multi_match": {"query": string,
-#                                                               "operator": "and",
-                                                              "fields": ["label.ngrams", "label.snowball^20"],  # ["label.label", "label.ngrams"],  # , "label.ngrams" ,"label.snowball^50",  "label.snowball^20", "label.shingles",
-                                                              }}},
-                              size=top, doc_type=self.type)['hits']
+    def label_query(self, string, verbose=False, max_degree=None):
+        query = {"multi_match": {"query": string,
+#                                 "operator": "and",
+                                 "fields": ["label.ngrams", "label.snowball^20"],  # ["label.label", "label.ngrams"],  # , "label.ngrams" ,"label.snowball^50",  "label.snowball^20", "label.shingles",
+                                 }}
+        # avoid heavy hitters: filter by the entity degree on the server side (count is a numeric field)
+        if max_degree:
+            query = {"bool": {"must": query, "filter": {"range": {"count": {"lte": max_degree}}}}}
+        # fetch only the fields we need
+        source = ['id', 'uri'] if verbose else ['id']
+        return {"query": query, "_source": source}
+
+    def span_scores(self, matches, verbose=False, threshold=1.0, scale=None):
         span_ids = {}
-        for match in matches['hits']:
+        for match in matches.get('hits', []):
             _id = match['_source']['id']
-            degree = int(match['_source']['count'])
-            if max_degree and degree <= max_degree:
-              score = match['_score'] / matches['max_score']
-              if not threshold or score >= threshold:
-                  if scale:
+            score = match['_score'] / matches['max_score']
+            if not threshold or score >= threshold:
+                if scale:
                     score *= scale
-                  span_ids[_id] = score
-                  if verbose:
+                span_ids[_id] = score
+                if verbose:
                     print({match['_source']['uri']: score})
 
         return span_ids
 
+    def label_scores(self, string, top=100, verbose=False, threshold=1.0, scale=None, max_degree=None):
+        es_requests.inc(index=self.index, method='label_scores')
+        matches = self.es.search(index=self.index,
+                              body=self.label_query(string, verbose, max_degree),
+                              filter_path=['hits.max_score', 'hits.hits._score', 'hits.hits._source'],
+                              size=top, doc_type=self.type).get('hits', {})
+        return self.span_scores(matches, verbose, threshold, scale)
+
+    def label_scores_batch(self, strings, top=100, verbose=False, threshold=1.0, scale=None, max_degree=None):
+        '''
+        label_scores for several strings in a single round trip (multi search)
+        top -- number of matches for all strings or a list with the number of matches for each string
+        '''
+        if not strings:
+            return []
+        tops = top if isinstance(top, list) else [top] * len(strings)
+        body = []
+        for string, top in zip(strings, tops):
+            body.append({"index": self.index, "type": self.type})
+            body.append(dict(self.label_query(string, verbose, max_degree), size=top))
+        # hits.total and error are kept so that every string has a response, even without matches
+        es_requests.inc(index=self.index, method='label_scores_batch')
+        responses = self.es.msearch(body=body,
+                                    filter_path=['responses.error', 'responses.hits.total', 'responses.hits.max_score',
+                                                 'responses.hits.hits._score', 'responses.hits.hits._source'])['responses']
+        assert len(responses) == len(strings)
+        return [self.span_scores(response.get('hits', {}), verbose, threshold, scale) for response in responses]
+
     def look_up_by_uri(self, uri, top=1):
         uri = uri.replace("'", "")
+        es_requests.inc(index=self.index, method='look_up_by_uri')
         results = self.es.search(index=self.index,
                               body={"query": {"term": {"uri": uri}}},
                               size=top, doc_type=self.type)['hits']['hits']
         if not results:
+            es_requests.inc(index=self.index, method='look_up_by_uri')
             results = self.es.search(index=self.index,
                               body={"query": {"term": {"uri": uri.replace("–", "-")}}},
                               size=top, doc_type=self.type)['hits']['hits']
             if not results:
+                es_requests.inc(index=self.index, method='look_up_by_uri')
                 results = self.es.search(index=self.index,
                                           body={"query": {"term": {"uri": quote(uri, safe=string.punctuation)}}},
                                           size=top, doc_type=self.type)['hits']['hits']
@@ -70,18 +108,86 @@ class IndexSearch:
         return results
 
     def look_up_by_id(self, _id, top=1):
+        es_requests.inc(index=self.index, method='look_up_by_id')
         results = self.es.search(index=self.index,
                               body={"query": {"term": {"id": _id}}},
                               size=top, doc_type=self.type)['hits']['hits']
         return results
 
+    def look_up_by_ids(self, ids, fields=['id', 'uri', 'label_exact', 'count'], chunk_size=10000):
+        '''
+        Batch look up: a single terms query per chunk of ids instead of a query per id
+        '''
+        ids = list(ids)
+        results = []
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i+chunk_size]
+            es_requests.inc(index=self.index, method='look_up_by_ids')
+            results.extend(self.es.search(index=self.index,
+                                          body={"query": {"constant_score": {"filter": {"terms": {"id": chunk}}}},
+                                                "_source": fields},
+                                          filter_path=['hits.hits._source'],
+                                          size=len(chunk), doc_type=self.type).get('hits', {}).get('hits', []))
+        return results
+
     def look_up_by_label(self, _id):
+        es_requests.inc(index=self.index, method='look_up_by_label')
         results = self.es.search(index=self.index,
                                  body={"query": {"term": {"label_exact": _id}}},
                                  doc_type=self.type)['hits']['hits']
         return results
 
 
+# keep a small catalog (e.g. the predicates) in memory to look up ids by label without ES round trips
+from elasticsearch.helpers import scan
+import numpy as np
+
+class LabelTable:
+
+    def __init__(self, index):
+        '''
+        Load all documents of the index and group their ids by the exact label
+        '''
+        labels, ids, uris = [], [], []
+        for doc in scan(index.es, index=index.index, doc_type=index.type,
+                        query={"query": {"match_all": {}}, "_source": ['id', 'uri', 'label_exact']}):
+            labels.append(doc['_source']['label_exact'])
+            ids.append(doc['_source']['id'])
+            uris.append(doc['_source']['uri'])
+        # sort by label so that all ids of the same label form a contiguous block
+        labels = np.asarray(labels)
+        order = np.argsort(labels, kind='mergesort')
+        self.ids = np.asarray(ids)[order]
+        self.uris = np.asarray(uris, dtype=object)[order]
+        unique_labels, starts = np.unique(labels[order], return_index=True)
+        self.offsets = np.append(starts, len(order))
+        self.rows = {label: i for i, label in enumerate(unique_labels.tolist())}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, label):
+        return label in self.rows
+
+    def look_up_by_labels(self, labels):
+        '''
+        Batch look up: returns the positions of all documents matching the labels
+        and for each position the index of the label it was matched by
+        '''
+        rows = np.array([self.rows.get(label, -1) for label in labels], dtype=np.int64)
+        found = np.flatnonzero(rows >= 0)
+        starts = self.offsets[rows[found]]
+        counts = self.offsets[rows[found] + 1] - starts
+        # gather the blocks of all labels at once
+        owners = np.repeat(found, counts)
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return positions, owners
+
+    def ids_by_labels(self, labels):
+        positions, owners = self.look_up_by_labels(labels)
+        return self.ids[positions], owners
+
+
 # connect to MongoDB (27017 is the default port) to access the dataset
 # sudo service mongod start 
 from pymongo import MongoClient
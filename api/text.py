@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Text processing for the question models that does not depend on Keras (importing Keras loads TensorFlow)
+'''
+import re, string
+
+import numpy as np
+
+question_types = ['SELECT', 'ASK', 'COUNT']
+
+
+# same tokenization as keras.preprocessing.text.text_to_word_sequence with the default arguments
+filters = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n'
+translate_map = str.maketrans({c: ' ' for c in filters})
+
+def text_to_word_sequence(text):
+    return [word for word in text.lower().translate(translate_map).split(' ') if word]
+
+
+# prediction time span generator
+def collect_mentions(words, y_p, tag_ind):
+    e_span, e_spans = [], []
+    for w, pred in zip(words, y_p):
+        if pred == tag_ind:
+            e_span.append(w)
+        elif e_span:
+            e_spans.append(" ".join(e_span))
+            e_span = []
+    # add last span
+    if e_span:
+        e_spans.append(" ".join(e_span))
+        e_span = []
+    # remove duplicates
+    return list(set(e_spans))
+
+
+# collect the spans for several tags in a single pass, same output as collect_mentions for each of the tags
+def collect_all_mentions(words, y_p, tag_inds):
+    spans = {tag_ind: [] for tag_ind in tag_inds}
+    span, span_tag = [], None
+    for w, pred in zip(words, y_p):
+        if span and pred != span_tag:
+            spans[span_tag].append(" ".join(span))
+            span = []
+        if pred in spans:
+            span.append(w)
+            span_tag = pred
+    # add last span
+    if span:
+        spans[span_tag].append(" ".join(span))
+    # remove duplicates
+    return [list(set(spans[tag_ind])) for tag_ind in tag_inds]
+
+
+# decode the outputs of the question type and the EP spans models for a batch of tokenized questions,
+# shared by KBQA.parse and the evaluation scripts (src/frontend.py)
+def decode_parses(q_words, y_qt, y_ep):
+    y_qt = np.argmax(y_qt, axis=-1).tolist()
+    y_ep = np.argmax(y_ep, axis=-1).tolist()
+    parses = []
+    for words, qt, tags in zip(q_words, y_qt, y_ep):
+        e_spans1, p_spans1, p_spans2 = collect_all_mentions(words, tags, [1, 2, 3])
+        parses.append({'question_type': question_types[qt], 'e_spans1': e_spans1, 'p_spans1': p_spans1, 'p_spans2': p_spans2})
+    return parses
+
+
+def preprocess_span(span):
+    entity_label = " ".join(re.sub('([a-z])([A-Z])', r'\1 \2', span).split())
+    words = entity_label.split('_')
+    unique_words = []
+    for word in words:
+        # strip punctuation
+        word = "".join([c for c in word if c not in string.punctuation])
+        if word:
+            word = word.lower()
+            if word not in unique_words:
+                unique_words.append(word)
+    return " ".join(unique_words)
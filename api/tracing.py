@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Per-request tracing: a tree of spans with the stage timings and candidate counts (optionally the payloads:
+spans, candidate and answer ids) written as one JSON line per request
+
+Disabled by default: requests get the no-op null_span unless they are sampled or ask for a trace
+
+The request log (one JSON line per request with its latency and stage breakdown) is replayed by loadtest.py
+'''
+import json
+import time
+import uuid
+import random
+import threading
+
+
+class NullSpan:
+    '''
+    No-op span: tracing disabled
+    '''
+    payloads = False
+
+    def span(self, name, **attributes):
+        return self
+
+    def add(self, name, start, end, **attributes):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+null_span = NullSpan()
+
+
+class Span:
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.start = time.time()
+        self.end = None
+        self.attributes = attributes
+        self.children = []
+
+    def span(self, name, **attributes):
+        '''
+        Child span, use as a context manager to time it
+        '''
+        child = Span(name, **attributes)
+        self.children.append(child)
+        return child
+
+    def add(self, name, start, end, **attributes):
+        '''
+        Child span of a stage timed elsewhere, e.g. a batch shared by several requests
+        '''
+        child = self.span(name, **attributes)
+        child.start, child.end = start, end
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.time()
+        if exc_value is not None:
+            self.attributes['error'] = repr(exc_value)
+        return False
+
+    def to_dict(self, origin):
+        return {'name': self.name, 'start_ms': (self.start - origin) * 1000,
+                'ms': (self.end - self.start) * 1000 if self.end else None,
+                'attributes': self.attributes, 'children': [child.to_dict(origin) for child in self.children]}
+
+
+class Trace(Span):
+
+    def __init__(self, name, payloads=False, export=True, **attributes):
+        '''
+        payloads -- also record the spans, candidate ids and answer ids (see KBQA.answer)
+        export -- write the trace when it is finished, False for the stage breakdown of the request log only
+        '''
+        super().__init__(name, **attributes)
+        self.trace_id = uuid.uuid4().hex
+        self.payloads = payloads
+        self.export = export
+
+    def stages(self):
+        '''
+        Milliseconds per stage, summed over the tree (e.g. the KG pages of both hops)
+        '''
+        stages = {}
+        spans = list(self.children)
+        while spans:
+            span = spans.pop()
+            if span.end:
+                stages[span.name] = stages.get(span.name, 0) + (span.end - span.start) * 1000
+            spans.extend(span.children)
+        return stages
+
+    def to_json(self):
+        trace = self.to_dict(self.start)
+        trace.update({'trace_id': self.trace_id, 'timestamp': self.start})
+        return json.dumps(trace, default=str)
+
+
+class JsonLines:
+    '''
+    Append-only JSON lines file shared by the threads of a process
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = record if isinstance(record, str) else json.dumps(record, default=str)
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+class Tracer:
+
+    def __init__(self, path='traces.jsonl', sample_rate=0.0, payloads=False):
+        '''
+        path -- JSON lines file the traces are appended to
+        sample_rate -- fraction of the requests traced without asking for it
+        payloads -- record the payloads in the sampled traces
+        '''
+        self.traces = JsonLines(path)
+        self.sample_rate = sample_rate
+        self.payloads = payloads
+
+    def start(self, name, force=False, payloads=None, **attributes):
+        '''
+        Trace of a request, the null span if it is not traced
+        force -- trace this request, e.g. asked for with a header
+        '''
+        if not force and (not self.sample_rate or random.random() >= self.sample_rate):
+            return null_span
+        return Trace(name, self.payloads if payloads is None else payloads, **attributes)
+
+    def finish(self, trace):
+        if trace is null_span or not trace.export:
+            return
+        if trace.end is None:
+            trace.end = time.time()
+        self.traces.write(trace.to_json())
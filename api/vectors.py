@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Nov 8, 2019
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Embedding matrices exported from Magnitude into memory-mapped numpy arrays
+
+Export once:
+python vectors.py
+
+The export writes <name>.npy with one vector per row and <name>.vocab with one key per line
+'''
+import io
+import threading
+
+import numpy as np
+
+from text import text_to_word_sequence
+
+
+vector_tables = {'fasttext_p_labels': "predicates_labels_fasttext",
+                 'glove840B300d': "glove.840B.300d.lcquad"}
+
+
+def export_vectors(vectors, path, dtype=np.float32, chunk_size=100000):
+    '''
+    Dump all (key, vector) pairs of a Magnitude file into a contiguous normalized matrix
+    '''
+    matrix = np.lib.format.open_memmap(path+'.npy', mode='w+', dtype=dtype, shape=(len(vectors), vectors.dim))
+    keys = []
+    chunk = []
+    for key, vector in vectors:
+        keys.append(key)
+        chunk.append(vector)
+        if len(chunk) == chunk_size:
+            matrix[len(keys)-len(chunk):len(keys)] = normalize_rows(np.asarray(chunk))
+            chunk = []
+    if chunk:
+        matrix[len(keys)-len(chunk):len(keys)] = normalize_rows(np.asarray(chunk))
+    matrix.flush()
+    with io.open(path+'.vocab', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(keys))
+    print("Exported %d vectors to %s" % (len(keys), path))
+
+
+def export_word_vectors(vectors, path, words, dtype=np.float16, chunk_size=10000):
+    '''
+    Dump the vectors of the selected words (Magnitude also generates the vectors for OOV words)
+    The first row is the zero vector used for padding
+    '''
+    words = [''] + sorted(set(words) - {''})
+    matrix = np.lib.format.open_memmap(path+'.npy', mode='w+', dtype=dtype, shape=(len(words), vectors.dim))
+    matrix[0] = 0
+    for i in range(1, len(words), chunk_size):
+        matrix[i:i+chunk_size] = vectors.query(words[i:i+chunk_size])
+    matrix.flush()
+    with io.open(path+'.vocab', 'w', encoding='utf-8') as f:
+        f.write('\n'.join(words))
+    print("Exported %d word vectors to %s" % (len(words)-1, path))
+
+
+def question_vocabulary(questions, frequencies_path, top_n=50000):
+    '''
+    All words of the dataset questions and the top_n most frequent English words (SUBTLEX-US frequency list)
+    '''
+    words = set(word for question in questions for word in text_to_word_sequence(question))
+    counts = []
+    with io.open(frequencies_path, 'r', encoding='utf-8') as f:
+        next(f)
+        for line in f:
+            parse = line.split('\t')
+            counts.append((int(parse[1]), parse[0].lower()))
+    words.update(word for count, word in sorted(counts, reverse=True)[:top_n])
+    return words
+
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+class LazyVectors:
+    '''
+    Magnitude vectors opened on the first query, e.g. by a forked worker of serve.py only once it meets an OOV word
+    '''
+
+    def __init__(self, load):
+        '''
+        load -- function opening the Magnitude vectors
+        '''
+        self.load = load
+        self.vectors = None
+        self.lock = threading.Lock()
+
+    def query(self, *args, **kwargs):
+        if self.vectors is None:
+            with self.lock:
+                if self.vectors is None:
+                    self.vectors = self.load()
+        return self.vectors.query(*args, **kwargs)
+
+
+class VectorTable:
+
+    def __init__(self, path, fallback=None):
+        '''
+        fallback -- Magnitude vectors used to embed queries that are not in the vocabulary (OOV)
+        '''
+        self.vectors = np.load(path+'.npy', mmap_mode='r')
+        with io.open(path+'.vocab', 'r', encoding='utf-8') as f:
+            self.keys = f.read().split('\n')
+        self.rows = {key: i for i, key in enumerate(self.keys)}
+        self.fallback = fallback
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+
+class WordVectorTable(VectorTable):
+    '''
+    Word embeddings restricted to the vocabulary we need: embedding a batch of questions is a single gather
+    (row 0 is reserved for the zero padding vector, see export_word_vectors)
+    '''
+
+    def query(self, sentences, pad_to_length):
+        '''
+        Same as Magnitude.query for a list of tokenized sentences: zero-padded (or truncated) to pad_to_length
+        '''
+        rows = np.zeros((len(sentences), pad_to_length), dtype=np.int64)
+        oov = []
+        for i, words in enumerate(sentences):
+            for j, word in enumerate(words[:pad_to_length]):
+                row = self.rows.get(word)
+                if row:
+                    rows[i, j] = row
+                else:
+                    oov.append((i, j, word))
+        x = np.asarray(self.vectors[rows], dtype=np.float32)
+        # only words outside of the exported vocabulary are sent to Magnitude
+        if oov and self.fallback is not None:
+            x[[i for i, _, _ in oov], [j for _, j, _ in oov]] = self.fallback.query([word for _, _, word in oov])
+        return x
+
+
+class SimilarityIndex(VectorTable):
+    '''
+    Exact top-k cosine similarity over the exported matrix: all queries are scored with a single matrix product
+    '''
+
+    def query(self, keys):
+        '''
+        Normalized vectors for a list of keys
+        '''
+        matrix = np.zeros((len(keys), self.vectors.shape[1]), dtype=np.float32)
+        rows = [self.rows.get(key, -1) for key in keys]
+        known = [i for i, row in enumerate(rows) if row >= 0]
+        if known:
+            matrix[known] = self.vectors[[rows[i] for i in known]]
+        oov = [i for i, row in enumerate(rows) if row < 0]
+        if oov and self.fallback is not None:
+            matrix[oov] = normalize_rows(np.asarray(self.fallback.query([keys[i] for i in oov]), dtype=np.float32))
+        return matrix
+
+    def most_similar(self, keys, topn=10):
+        '''
+        Batch version of Magnitude.most_similar: for every key returns
+        whether it is in the vocabulary (exact match) and the list of the topn (key, similarity) pairs
+        sorted by similarity, excluding the key itself
+        '''
+        if not keys:
+            return []
+        matrix = self.query(keys)
+        similarities = np.dot(matrix, self.vectors.T)
+        # exclude the query keys from their own results
+        for i, key in enumerate(keys):
+            if key in self.rows:
+                similarities[i, self.rows[key]] = -np.inf
+        # nothing is similar to OOV keys without a fallback
+        similarities[~matrix.any(axis=1)] = -np.inf
+        topn = min(topn, len(self.keys) - 1)
+        if topn <= 0:
+            return [(key in self.rows, []) for key in keys]
+        top = np.argpartition(-similarities, topn-1, axis=1)[:, :topn]
+        top_similarities = np.take_along_axis(similarities, top, axis=1)
+        order = np.argsort(-top_similarities, axis=1, kind='mergesort')
+        top = np.take_along_axis(top, order, axis=1)
+        top_similarities = np.take_along_axis(top_similarities, order, axis=1)
+        results = []
+        for key, rows, scores in zip(keys, top.tolist(), top_similarities.tolist()):
+            results.append((key in self.rows, [(self.keys[row], score) for row, score in zip(rows, scores) if score > -np.inf]))
+        return results
+
+
+def load_vector_table(embeddings_path, embeddings_choice, fallback=None):
+    return SimilarityIndex(embeddings_path+vector_tables[embeddings_choice], fallback)
+
+
+def load_word_vector_table(embeddings_path, embeddings_choice, fallback=None):
+    return WordVectorTable(embeddings_path+vector_tables[embeddings_choice], fallback)
+
+
+if __name__ == '__main__':
+    from setup import load_embeddings, Mongo_Connector
+    from request import embeddings_path, embeddings_choice
+    export_vectors(load_embeddings(embeddings_path, 'fasttext_p_labels'), embeddings_path+vector_tables['fasttext_p_labels'])
+    # question words: LC-QuAD vocabulary and frequent English words
+    questions = [doc['question'] for doc in Mongo_Connector('kbqa', 'lcquad').get_all(limit=None)]
+    words = question_vocabulary(questions, '../data/SUBTLEXus74286wordstextversion.txt')
+    export_word_vectors(load_embeddings(embeddings_path, embeddings_choice), embeddings_path+vector_tables[embeddings_choice], words)
@@ -14,9 +14,28 @@ Evaluate entity linking performance and store annotations
 dataset_name = 'lcquad'
 
 import os
+import sys
 from setup import IndexSearch, Mongo_Connector, load_embeddings
 
 e_vectors = load_embeddings('fasttext_e_labels')
+
+# candidate labels from the approximate nearest neighbour index instead of the KG neighbours (see ann_index.py)
+# python EL.py ann
+use_ann = sys.argv[1:] == ['ann']
+# nearest labels per span
+ann_k = 100
+e_ann = None
+
+
+def load_ann():
+    global e_ann
+    if e_ann is None:
+        from ann_index import LabelANN, ann_name
+        from setup import embeddings_path
+        e_ann = LabelANN(e_vectors, embeddings_path+ann_name)
+    return e_ann
+
+
 e_index = IndexSearch('dbpedia201604e')
 mongo = Mongo_Connector('kbqa', dataset_name)
 
@@ -37,7 +56,7 @@ namespace = "http://dbpedia.org/"
 
 import numpy as np
 print("Entity linking...")
-def entity_linking(spans_field, save, show_errors=True, add_nieghbours=True, lookup_embeddings=True):
+def entity_linking(spans_field, save, show_errors=True, add_nieghbours=True, lookup_embeddings=True, use_ann=use_ann):
     # iterate over the cursor
     cursor = mongo.get_sample(limit=limit)
     count = 0
@@ -74,20 +93,21 @@ def entity_linking(spans_field, save, show_errors=True, add_nieghbours=True, loo
     #                 print(uri)
 
                 print("%d candidate labels"%len(guessed_labels))
-                if add_nieghbours:
+                # the nearest labels from the ANN index replace the KG neighbours
+                if add_nieghbours and not (use_ann and lookup_embeddings):
                     print("KG lookup..")
                     kg = HDTDocument(hdt_path+hdt_file)
                     kg.configure_hops(1, [], namespace, True)
                     # get a sample of the subgraph: the first <max_triples> only
                     entities, predicate_ids, adjacencies = kg.compute_hops(look_up_ids, max_triples, 0)
                     kg.remove()
-                    # look up labels
-                    for e_id in entities:
-                        match = e_index.look_up_by_id(e_id)
-                        if match:
-                            label = match[0]['_source']['label_exact']
-                            if label not in guessed_labels:
-                                guessed_labels.append(label)
+                    # look up labels of all neighbours in one batch and skip the duplicates
+                    seen_labels = set(guessed_labels)
+                    for match in e_index.look_up_by_ids(set(entities), fields=['label_exact']):
+                        label = match['_source']['label_exact']
+                        if label not in seen_labels:
+                            seen_labels.add(label)
+                            guessed_labels.append(label)
                     guessed_ids.extend(entities)
 
                 # score with embeddings
@@ -95,7 +115,17 @@ def entity_linking(spans_field, save, show_errors=True, add_nieghbours=True, loo
                 print("%d candidate labels"%len(guessed_labels))
                 if guessed_labels and lookup_embeddings:
                     print("Embeddings lookup..")
-                    dists = e_vectors.distance(span, [label for label in guessed_labels if label in e_vectors])
+                    dists = list(e_vectors.distance(span, guessed_labels))
+                    if use_ann:
+                        print("ANN lookup..")
+                        # the angular distances of the index are on the same scale as e_vectors.distance
+                        ann_labels, ann_dists = load_ann().nearest(span, k=ann_k)
+                        seen_labels = set(guessed_labels)
+                        for label, distance in zip(ann_labels, ann_dists):
+                            if label not in seen_labels:
+                                seen_labels.add(label)
+                                guessed_labels.append(label)
+                                dists.append(distance)
                     top = np.argsort(dists)[:semantic_cutoff].tolist()
                     top_labels = [guessed_labels[i] for i in top]
                     print("selected labels: %s"%top_labels)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Jan 8, 2018
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Approximate nearest neighbour (Annoy) index over the entity label embeddings
+EL.py (python EL.py ann) takes the nearest labels of a span as its candidates instead of the labels of the KG
+neighbours: only the string-matched labels are scored exactly
+
+Build the index offline once (stores <name>.ann and <name>.vocab next to the embeddings):
+python ann_index.py build
+
+Evaluate recall against the exact Magnitude scan on the LC-QuAD entity spans:
+python ann_index.py benchmark
+'''
+import io
+import sys
+import time
+
+import numpy as np
+from annoy import AnnoyIndex
+
+from setup import embeddings_path, load_embeddings, Mongo_Connector
+
+ann_name = 'terms_labels_fasttext'
+n_trees = 50
+# nodes inspected per query: bounds the query time independently of k
+search_k = 5000
+
+
+def build_index(vectors, path, n_trees=n_trees):
+    '''
+    Index all labels of the Magnitude file: Annoy item i corresponds to the i-th line of the vocab file
+    '''
+    index = AnnoyIndex(vectors.dim, 'angular')
+    with io.open(path+'.vocab', 'w', encoding='utf-8') as vocab:
+        for i, (label, vector) in enumerate(vectors):
+            index.add_item(i, vector)
+            vocab.write(label+'\n')
+    print("Building %d trees for %d labels.." % (n_trees, index.get_n_items()))
+    index.build(n_trees)
+    index.save(path+'.ann')
+
+
+class LabelANN:
+
+    def __init__(self, vectors, path, search_k=search_k):
+        '''
+        vectors -- Magnitude embeddings used to embed the query spans
+        search_k -- number of nodes to inspect at query time (-1 for Annoy's default of n_trees * k)
+        '''
+        self.vectors = vectors
+        self.search_k = search_k
+        # the index file is memory-mapped by Annoy
+        self.index = AnnoyIndex(vectors.dim, 'angular')
+        self.index.load(path+'.ann')
+        with io.open(path+'.vocab', 'r', encoding='utf-8') as vocab:
+            self.labels = vocab.read().split('\n')[:-1]
+
+    def nearest(self, span, k=10):
+        '''
+        Returns the k nearest labels and their distances. The angular distance sqrt(2(1-cos)) between
+        normalized vectors is the same as the Euclidean distance reported by Magnitude.distance
+        '''
+        items, distances = self.index.get_nns_by_vector(self.vectors.query(span), k,
+                                                        search_k=self.search_k, include_distances=True)
+        return [self.labels[i] for i in items], distances
+
+
+def benchmark(ann, spans, k=100):
+    '''
+    Recall@k of the ANN index with respect to the exact nearest neighbours and query latency
+    '''
+    recalls, ann_times, exact_times = [], [], []
+    for span in spans:
+        start = time.time()
+        labels, _ = ann.nearest(span, k)
+        ann_times.append(time.time() - start)
+
+        start = time.time()
+        exact = [label for label, _ in ann.vectors.most_similar(span, topn=k)]
+        # most_similar excludes the query itself
+        if span in ann.vectors:
+            exact = [span] + exact[:-1]
+        exact_times.append(time.time() - start)
+
+        recalls.append(float(len(set(labels) & set(exact))) / len(exact))
+
+    print("%d spans" % len(spans))
+    print("Recall@%d: %.3f" % (k, np.mean(recalls)))
+    print("ANN: %.3f ms per query (p95 %.3f ms)" % (np.mean(ann_times)*1000, np.percentile(ann_times, 95)*1000))
+    print("Exact: %.3f ms per query" % (np.mean(exact_times)*1000))
+
+
+def lcquad_spans(limit=None):
+    mongo = Mongo_Connector('kbqa', 'lcquad')
+    spans = set()
+    with mongo.get_sample(train=False, limit=limit) as cursor:
+        for doc in cursor:
+            spans.update(doc['entity_spans'])
+    return sorted(spans)
+
+
+if __name__ == '__main__':
+    e_vectors = load_embeddings('fasttext_e_labels')
+    if sys.argv[1:] == ['build']:
+        build_index(e_vectors, embeddings_path+ann_name)
+    else:
+        benchmark(LabelANN(e_vectors, embeddings_path+ann_name), lcquad_spans())
@@ -70,21 +70,7 @@ from keras_contrib.layers import CRF
 from keras_contrib import losses, metrics
 
 
-# prediction time span generator
-def collect_mentions(words, y_p, tag_ind):
-    e_span, e_spans = [], []
-    for w, pred in zip(words, y_p):
-        if pred == tag_ind:
-            e_span.append(w)
-        elif e_span:
-            e_spans.append(" ".join(e_span))
-            e_span = []
-    # add last span
-    if e_span:
-        e_spans.append(" ".join(e_span))
-        e_span = []
-    # remove duplicates
-    return list(set(e_spans))
+from frontend import FrontEnd
 
 
 # define bi-LSTM model architecture (loose embeddings layer to do on-the-fly embedding at inference time)
@@ -335,34 +321,22 @@ n_missing_spans = 0
 
 new_answers = ['134', '1839', '2450', '3213', '3237', '3302', '4390', '4972']
 
+# run the neural front-end over batches of questions
+front_end = FrontEnd(qt_model, ep_model, word_vectors, model_settings)
+
+
 cursor = mongo.get_sample(train=False, limit=limit)
 # cursor = mongo.get_by_id('63', limit=1)
 with cursor:
     print("Evaluating...")
-    for doc in cursor:
+    for doc, parse, parse_time in front_end.parse_cursor(cursor):
+        p_qt, e_spans1, p_spans1, p_spans2 = parse['question_type'], parse['e_spans1'], parse['p_spans1'], parse['p_spans2']
         doc_id = doc['SerialNumber']
 #         if doc_id not in new_answers:
 #             continue
         q = doc['question']
                 
-        # parse question into words and embed
-        x_test_sent = np.zeros((model_settings['max_len'], model_settings['emb_dim']))
-        q_words = text_to_word_sequence(q)
-        for i, word in enumerate(q_words):
-            x_test_sent[i] = word_vectors.query(word)
-        
-        # predict question type
-        y_p = qt_model.predict(np.array([x_test_sent]))
-        y_p = np.argmax(y_p, axis=-1)[0]
-        p_qt = question_types[y_p]
         ask_question = p_qt == 'ASK'
-        
-        # use GS spans + preprocess
-        y_p = ep_model.predict(np.array([x_test_sent]))
-        y_p = np.argmax(y_p, axis=-1)[0]
-        e_spans1 = collect_mentions(q_words, y_p, 1)
-        p_spans1 = collect_mentions(q_words, y_p, 2)
-        p_spans2 = collect_mentions(q_words, y_p, 3)
 
 #         c_spans1 = doc['c1_spans']
 #         c_spans2 = doc['c2_spans']
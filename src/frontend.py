@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Created on Feb 20, 2018
+
+.. codeauthor: svitlana vakulenko
+    <svitlana.vakulenko@gmail.com>
+
+Batched neural front-end of the evaluation scripts: question types and EP spans for batches of questions
+
+The questions are tokenized and the model outputs decoded by api/text.py, as in KBQA.parse, so that the
+evaluation and the API parse the same way
+'''
+import os
+import sys
+import time
+
+import numpy as np
+
+# api/text.py does not depend on the rest of the API (appended: the modules of src come first)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+from text import text_to_word_sequence, decode_parses
+
+batch_size = 32
+
+
+class FrontEnd:
+
+    def __init__(self, qt_model, ep_model, word_vectors, model_settings, batch_size=batch_size):
+        self.qt_model = qt_model
+        self.ep_model = ep_model
+        self.word_vectors = word_vectors
+        self.model_settings = model_settings
+        self.batch_size = batch_size
+
+    def parse_questions(self, questions):
+        '''
+        Predict the question types and the EP spans for a batch of questions: a dict per question as returned by KBQA.parse
+        '''
+        max_len = self.model_settings['max_len']
+        # parse questions into words and embed all of them at once
+        q_words = [text_to_word_sequence(q)[:max_len] for q in questions]
+        x = np.zeros((len(questions), max_len, self.model_settings['emb_dim']))
+        rows = [i for i, words in enumerate(q_words) if words]
+        if rows:
+            x[rows] = self.word_vectors.query([q_words[i] for i in rows], pad_to_length=max_len)
+        # predict question types and spans for the whole batch
+        y_qt = self.qt_model.predict(x, batch_size=len(x))
+        y_ep = self.ep_model.predict(x, batch_size=len(x))
+        return decode_parses(q_words, y_qt, y_ep)
+
+    def parse_batch(self, batch):
+        '''
+        Returns the (document, parse, parse time) triples of a batch,
+        the parse time of the batch is divided between its questions
+        '''
+        start = time.time()
+        parses = self.parse_questions([doc['question'] for doc in batch])
+        parse_time = (time.time() - start) / len(batch)
+        return [(doc, parse, parse_time) for doc, parse in zip(batch, parses)]
+
+    def parse_cursor(self, cursor):
+        '''
+        Iterate over the dataset documents together with their parses and parse times
+        '''
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) == self.batch_size:
+                yield from self.parse_batch(batch)
+                batch = []
+        if batch:
+            yield from self.parse_batch(batch)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+'''
+Batched NumPy decoding for the ChainCRF layer (no Keras graph needed)
+
+Takes the emissions x of shape (batch, time, tags) computed by any encoder and the learned
+parameters of the layer: U, b_start, b_end = chain_crf_layer.get_weights()
+The results are the same as the symbolic viterbi_decode in ChainCRF.py, including the mask handling.
+'''
+
+import numpy as np
+
+
+def logsumexp(x, axis):
+    x_max = np.max(x, axis=axis, keepdims=True)
+    return np.squeeze(x_max, axis) + np.log(np.sum(np.exp(x - x_max), axis=axis))
+
+
+def add_boundary_energy(x, b_start=None, b_end=None, mask=None):
+    '''Adds the start (resp. end) boundary energy on the first (resp. last) unmasked
+    element of each sequence and zeroes the masked elements.'''
+    x = np.array(x, dtype=np.float32)
+    if mask is None:
+        if b_start is not None:
+            x[:, 0, :] += b_start
+        if b_end is not None:
+            x[:, -1, :] += b_end
+    else:
+        mask = np.asarray(mask, dtype=np.float32)
+        x *= mask[:, :, None]
+        if b_start is not None:
+            mask_r = np.concatenate([np.zeros_like(mask[:, :1]), mask[:, :-1]], axis=1)
+            x += (mask > mask_r)[:, :, None] * b_start
+        if b_end is not None:
+            mask_l = np.concatenate([mask[:, 1:], np.zeros_like(mask[:, -1:])], axis=1)
+            x += (mask > mask_l)[:, :, None] * b_end
+    return x
+
+
+def transition_energy(U, mask, n_steps):
+    '''Transition energies (batch or 1, time - 1, tags, tags) between consecutive unmasked elements.'''
+    U = np.asarray(U, dtype=np.float32)[None, None, :, :]
+    if mask is None:
+        return np.repeat(U, n_steps - 1, axis=1)
+    mask = np.asarray(mask, dtype=np.float32)
+    return U * (mask[:, :-1] * mask[:, 1:])[:, :, None, None]
+
+
+def viterbi_decode(x, U, b_start=None, b_end=None, mask=None):
+    '''Best tag sequences (batch, time) maximizing the path energy, masked elements are set to -1.'''
+    x = add_boundary_energy(x, b_start, b_end, mask)
+    n, n_steps, _ = x.shape
+    U_t = transition_energy(U, mask, n_steps)
+    # forward pass: best score of a path ending in each tag and the best previous tag
+    alpha = x[:, 0]
+    gamma = np.empty(x.shape, dtype=np.int64)
+    for t in range(1, n_steps):
+        scores = alpha[:, :, None] + U_t[:, t-1] + x[:, t, None, :]
+        gamma[:, t-1] = np.argmax(scores, axis=1)
+        alpha = np.max(scores, axis=1)
+    # backtracking from the best last tag
+    rows = np.arange(n)
+    y = np.empty((n, n_steps), dtype=np.int64)
+    y[:, -1] = np.argmax(alpha, axis=1)
+    for t in range(n_steps - 2, -1, -1):
+        y[:, t] = gamma[rows, t, y[:, t+1]]
+    if mask is not None:
+        y[np.asarray(mask) == 0] = -1
+    return y
+
+
+def forward_backward(x, U_t):
+    '''Log forward and backward messages (batch, time, tags).'''
+    n, n_steps, n_tags = x.shape
+    log_alpha = np.empty(x.shape, dtype=np.float32)
+    log_beta = np.zeros(x.shape, dtype=np.float32)
+    log_alpha[:, 0] = x[:, 0]
+    for t in range(1, n_steps):
+        log_alpha[:, t] = logsumexp(log_alpha[:, t-1, :, None] + U_t[:, t-1], axis=1) + x[:, t]
+    for t in range(n_steps - 2, -1, -1):
+        log_beta[:, t] = logsumexp(U_t[:, t] + (x[:, t+1] + log_beta[:, t+1])[:, None, :], axis=2)
+    return log_alpha, log_beta
+
+
+def free_energy(x, U, b_start=None, b_end=None, mask=None):
+    '''Log partition function over all tag sequences for each input.'''
+    x = add_boundary_energy(x, b_start, b_end, mask)
+    log_alpha, _ = forward_backward(x, transition_energy(U, mask, x.shape[1]))
+    return logsumexp(log_alpha[:, -1], axis=1)
+
+
+def marginals(x, U, b_start=None, b_end=None, mask=None):
+    '''Posterior probabilities (batch, time, tags) of each tag at each position, zero for masked elements.'''
+    x = add_boundary_energy(x, b_start, b_end, mask)
+    log_alpha, log_beta = forward_backward(x, transition_energy(U, mask, x.shape[1]))
+    log_z = logsumexp(log_alpha[:, -1], axis=1)
+    probabilities = np.exp(log_alpha + log_beta - log_z[:, None, None])
+    if mask is not None:
+        probabilities *= np.asarray(mask, dtype=np.float32)[:, :, None]
+    return probabilities
@@ -32,23 +32,28 @@ class IndexSearch:
                               size=top, doc_type=self.type)['hits']['hits']
 
     def label_scores(self, string, top=100, verbose=False, threshold=1.0, scale=None, max_degree=None):
+        query = {"multi_match": {"query": string,
+#                                 "operator": "and",
+                                 "fields": ["label.ngrams", "label.snowball^20"],  # ["label.label", "label.ngrams"],  # , "label.ngrams" ,"label.snowball^50",  "label.snowball^20", "label.shingles",
+                                 }}
+        # avoid heavy hitters: filter by the entity degree on the server side (count is a numeric field)
+        if max_degree:
+            query = {"bool": {"must": query, "filter": {"range": {"count": {"lte": max_degree}}}}}
+        # fetch only the fields we need
+        source = ['id', 'uri'] if verbose else ['id']
         matches = self.es.search(index=self.index,
-                              body={"query": {"multi_match": {"query": string,
-#                                                               "operator": "and",
-                                                              "fields": ["label.ngrams", "label.snowball^20"],  # ["label.label", "label.ngrams"],  # , "label.ngrams" ,"label.snowball^50",  "label.snowball^20", "label.shingles",
-                                                              }}},
-                              size=top, doc_type=self.type)['hits']
+                              body={"query": query, "_source": source},
+                              filter_path=['hits.max_score', 'hits.hits._score', 'hits.hits._source'],
+                              size=top, doc_type=self.type).get('hits', {})
         span_ids = {}
-        for match in matches['hits']:
+        for match in matches.get('hits', []):
             _id = match['_source']['id']
-            degree = int(match['_source']['count'])
-            if max_degree and degree <= max_degree:
-              score = match['_score'] / matches['max_score']
-              if not threshold or score >= threshold:
-                  if scale:
+            score = match['_score'] / matches['max_score']
+            if not threshold or score >= threshold:
+                if scale:
                     score *= scale
-                  span_ids[_id] = score
-                  if verbose:
+                span_ids[_id] = score
+                if verbose:
                     print({match['_source']['uri']: score})
 
         return span_ids
@@ -75,6 +80,21 @@ class IndexSearch:
                               size=top, doc_type=self.type)['hits']['hits']
         return results
 
+    def look_up_by_ids(self, ids, fields=['id', 'uri', 'label_exact', 'count'], chunk_size=10000):
+        '''
+        Batch look up: a single terms query per chunk of ids instead of a query per id
+        '''
+        ids = list(ids)
+        results = []
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i+chunk_size]
+            results.extend(self.es.search(index=self.index,
+                                          body={"query": {"constant_score": {"filter": {"terms": {"id": chunk}}}},
+                                                "_source": fields},
+                                          filter_path=['hits.hits._source'],
+                                          size=len(chunk), doc_type=self.type).get('hits', {}).get('hits', []))
+        return results
+
     def look_up_by_label(self, _id):
         results = self.es.search(index=self.index,
                                  body={"query": {"term": {"label_exact": _id}}},
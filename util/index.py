@@ -65,7 +65,8 @@ def uris_stream(index_name, file_path, ns_filter=None, doc_type='terms'):
                 continue
             entity_label = entity_uri.strip('/').split('/')[-1].strip('>').lower()
             label_words = parse_uri(entity_uri)
-            count = parse[-1].strip()
+            # store the degree as a number to allow range filters
+            count = int(parse[-1].strip())
             data_dict = {'uri': entity_uri, 'label': label_words,
                          'count': count, "id": i+1, 'label_exact': entity_label}
 